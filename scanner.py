@@ -7,6 +7,17 @@ import platform
 import json
 import asyncio
 import urllib.parse
+import time
+import hashlib
+import importlib.util
+
+BOOT_STARTED = time.perf_counter()
+BOOT_TIMINGS = []
+
+
+def mark_boot(phase: str):
+    BOOT_TIMINGS.append((phase, time.perf_counter() - BOOT_STARTED))
+
 
 # --- BOOT LOGS & WINDOWS ENCODING PATCH ---
 if platform.system() == 'Windows':
@@ -49,8 +60,16 @@ def get_resource_path(filename):
 CSV_FILE = os.path.join(BASE_DIR, "clean_ips.csv")
 CONFIG_FILE = os.path.join(BASE_DIR, "config.json")
 URI_FILE = os.path.join(BASE_DIR, "config.txt")
+CONFIGS_DIR = os.path.join(BASE_DIR, "configs")
+MATRIX_FILE = os.path.join(BASE_DIR, "compat_matrix.csv")
+DIST_RESULTS_FILE = os.path.join(BASE_DIR, "distributed_results.csv")
+DIST_SUBNETS_FILE = os.path.join(BASE_DIR, "distributed_subnets.csv")
 OUTPUT_DIR = os.path.join(BASE_DIR, "output_configs")
 ERROR_LOG_FILE = os.path.join(BASE_DIR, "scanner_error.log")
+XRAY_STAMP_FILE = os.path.join(BASE_DIR, "xray_stamp.json")
+SNI_REPUTATION_FILE = os.path.join(BASE_DIR, "sni_reputation.json")
+LATENCY_MAP_FILE = os.path.join(BASE_DIR, "latency_map")
+LATENCY_SUBNETS_FILE = os.path.join(BASE_DIR, "latency_subnets.csv")
 
 IPV4_FILE = get_resource_path("ipv4.txt")
 IPV6_FILE = get_resource_path("ipv6.txt")
@@ -61,9 +80,8 @@ def ensure_dependencies():
     required_packages = {"aiohttp": "aiohttp", "textual": "textual", "pyperclip": "pyperclip"}
     missing_packages = []
     for module_name, pip_name in required_packages.items():
-        try:
-            __import__(module_name)
-        except ImportError:
+        # find_spec only locates the package on disk; importing textual here would double the boot time.
+        if importlib.util.find_spec(module_name) is None:
             missing_packages.append(pip_name)
 
     if missing_packages:
@@ -80,6 +98,53 @@ def ensure_dependencies():
 
 
 if not IS_COMPILED: ensure_dependencies()
+mark_boot("dependencies")
+
+
+def file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""): digest.update(chunk)
+    return digest.hexdigest()
+
+
+def read_xray_stamp(xray_path: str) -> dict:
+    """Returns the cached stamp if it still describes the binary on disk, otherwise None.
+
+    Size and mtime are checked first. A matching size with a changed mtime (a
+    copy or an unzip that preserved the bytes) falls back to the hash.
+    """
+    try:
+        with open(XRAY_STAMP_FILE, 'r', encoding='utf-8') as f:
+            stamp = json.load(f)
+        st = os.stat(xray_path)
+    except (OSError, ValueError):
+        return None
+    if stamp.get("size") != st.st_size: return None
+    if stamp.get("mtime_ns") == st.st_mtime_ns: return stamp
+    if stamp.get("sha256") != file_sha256(xray_path): return None
+    stamp["mtime_ns"] = st.st_mtime_ns
+    write_xray_stamp(stamp)
+    return stamp
+
+
+def write_xray_stamp(stamp: dict):
+    try:
+        with open(XRAY_STAMP_FILE, 'w', encoding='utf-8') as f:
+            json.dump(stamp, f)
+    except OSError:
+        pass
+
+
+def verify_xray_binary(xray_path: str) -> dict:
+    """Runs `xray version` once and records a stamp so later launches can skip the subprocess."""
+    output = subprocess.run([xray_path, "version"], capture_output=True, text=True, check=True).stdout
+    st = os.stat(xray_path)
+    first_line = output.splitlines()[0] if output else ""
+    stamp = {"size": st.st_size, "mtime_ns": st.st_mtime_ns, "sha256": file_sha256(xray_path),
+             "version": first_line.split()[1] if len(first_line.split()) > 1 else "unknown"}
+    write_xray_stamp(stamp)
+    return stamp
 
 
 def ensure_xray_core():
@@ -91,9 +156,10 @@ def ensure_xray_core():
     xray_path = os.path.join(BASE_DIR, exe_name)
 
     if os.path.exists(xray_path):
+        if read_xray_stamp(xray_path): return
         try:
             # Self-Healing: Test if the existing binary is broken (e_type: 2)
-            subprocess.run([xray_path, "version"], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+            verify_xray_binary(xray_path)
             return
         except Exception:
             print("⚠️ Existing Xray binary is broken or incompatible with this architecture. Redownloading...")
@@ -144,30 +210,37 @@ def ensure_xray_core():
             import stat
             os.chmod(xray_path, os.stat(xray_path).st_mode | stat.S_IEXEC)
 
+        verify_xray_binary(xray_path)
         print("✅ Xray-core installed successfully!\n")
     except Exception as e:
         print(f"❌ Failed to auto-download Xray: {e}")
 
 
 ensure_xray_core()
+mark_boot("xray")
 
-import aiohttp
 import ssl
-import time
+import socket
 import random
 import ipaddress
 import csv
-import tempfile
 import logging
 import copy
+import base64
+import collections
+import contextlib
+import uuid
+import hmac
+import secrets
+import itertools
+import heapq
+import bisect
+from array import array
+import math
+import statistics
 import stat
-import pyperclip
 
-from textual import on
-from textual.app import App, ComposeResult
-from textual.widgets import Header, Footer, RichLog, DataTable, ProgressBar, Label, Button, Input, Switch
-from textual.containers import Horizontal, Vertical, Grid
-from textual.binding import Binding
+mark_boot("imports")
 
 if os.path.exists(ERROR_LOG_FILE):
     os.remove(ERROR_LOG_FILE)
@@ -184,6 +257,1584 @@ def get_system_socket_capacity() -> int:
     return min(cores * 150, 1000) if platform.system() == 'Windows' else min(cores * 300, 3000)
 
 
+CF_HTTPS_PORTS = (443, 2053, 2083, 2087, 2096, 8443)
+
+
+def parse_port_list(text: str) -> list:
+    if text.strip().lower() in ("cf", "all"): return list(CF_HTTPS_PORTS)
+    ports = set()
+    for token in text.replace(",", " ").split():
+        try:
+            port = int(token)
+        except ValueError:
+            continue
+        if 0 < port < 65536: ports.add(port)
+    return sorted(ports) or [443]
+
+
+def outbound_endpoint(config: dict) -> tuple:
+    """Returns (port, uses TLS) for the server of a config's first outbound, or (None, False) if it has none."""
+    try:
+        outbound = config["outbounds"][0]
+        servers = outbound["settings"].get("vnext") or outbound["settings"]["servers"]
+        security = outbound.get("streamSettings", {}).get("security", "none")
+        return int(servers[0]["port"]), security != "none"
+    except (KeyError, IndexError, TypeError, ValueError, AttributeError):
+        return None, False
+
+
+async def probe_tcp_ports(ip: str, ports: list, timeout: float = 1.5) -> dict:
+    """Opens one connection per port concurrently and returns {port: connect ms} for the ports that accepted."""
+
+    async def connect(port):
+        try:
+            start_time = time.monotonic()
+            _, writer = await asyncio.wait_for(asyncio.open_connection(ip, port), timeout=timeout)
+            connect_ms = (time.monotonic() - start_time) * 1000
+            writer.close()
+            await writer.wait_closed()
+            return port, connect_ms
+        except Exception:
+            return None
+
+    results = await asyncio.gather(*(connect(port) for port in ports))
+    return dict(result for result in results if result)
+
+
+class StageQueue(asyncio.PriorityQueue):
+    """Bounded hand-off between stages that keeps the best candidates when the next stage falls behind.
+
+    Items are offered with a priority (lower is better) and handed out best
+    first. When the queue is full, the worst of the queued and offered items
+    is dropped instead of the newest one, and every drop is counted.
+    """
+
+    def __init__(self, maxsize: int):
+        super().__init__(maxsize)
+        self.drops = 0
+        self._seq = itertools.count()
+
+    def _get(self):
+        return heapq.heappop(self._queue)[-1]
+
+    def offer(self, priority, item):
+        """Queues the item without waiting and returns whichever item was dropped for it, or None."""
+        entry = (priority, next(self._seq), item)
+        dropped = None
+        if self.full():
+            self.drops += 1
+            worst = max(range(len(self._queue)), key=self._queue.__getitem__)
+            if entry >= self._queue[worst]: return item
+            dropped = self._queue[worst][-1]
+            self._queue[worst] = self._queue[-1]
+            self._queue.pop()
+            heapq.heapify(self._queue)
+            self.task_done()
+        self.put_nowait(entry)
+        return dropped
+
+    async def push(self, priority, item):
+        """Queues the item, waiting for room instead of dropping anything."""
+        await self.put((priority, next(self._seq), item))
+
+
+SPEED_BASE_BYTES = 100_000
+SPEED_MAX_BYTES = 1_000_000
+XRAY_BASE_BYTES = 100_000
+XRAY_MAX_BYTES = 500_000
+
+MONITOR_INTERVAL = 60
+MONITOR_DECAY = 0.4
+MONITOR_EVICT_BELOW = 0.5
+
+
+class AdaptiveSpeedMeter:
+    """Judges a streaming download against a minimum rate while it is running.
+
+    Throughput is sampled in short windows. The test is abandoned as soon as
+    the upper confidence bound of the window rates drops below the minimum, and
+    it only runs past the base byte budget while the lower bound stays well
+    above it, so bad IPs cost little and good ones get a longer measurement.
+    """
+
+    CONTINUE, PASS, FAIL = "continue", "pass", "fail"
+    WINDOW = 0.1
+    MIN_SAMPLES = 3
+    Z = 2.0
+    PROMISING_FACTOR = 2.0
+
+    def __init__(self, min_kbps: float, base_bytes: int, max_bytes: int):
+        self.min_kbps = min_kbps
+        self.base_bytes = min(base_bytes, max_bytes)
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self.timed_bytes = 0
+        self.samples = []
+        self.started = None
+        self._window_start = None
+        self._window_bytes = 0
+
+    @property
+    def elapsed(self) -> float:
+        return time.monotonic() - self.started if self.started else 0.0
+
+    @property
+    def kbps(self) -> float:
+        return (self.timed_bytes / 1024) / max(self.elapsed, 0.01)
+
+    def _bounds(self) -> tuple:
+        if len(self.samples) < self.MIN_SAMPLES:
+            return self.kbps, self.kbps
+        mean = statistics.fmean(self.samples)
+        margin = self.Z * statistics.stdev(self.samples) / math.sqrt(len(self.samples))
+        return mean - margin, mean + margin
+
+    def feed(self, nbytes: int) -> str:
+        now = time.monotonic()
+        self.total_bytes += nbytes
+        if self.started is None:
+            # The clock starts at the first chunk so connection setup and TTFB
+            # do not count against throughput; that chunk itself is not timed.
+            self.started = self._window_start = now
+            return self.CONTINUE
+        while now - self._window_start >= self.WINDOW:
+            self.samples.append((self._window_bytes / 1024) / self.WINDOW)
+            self._window_start += self.WINDOW
+            self._window_bytes = 0
+        self._window_bytes += nbytes
+        self.timed_bytes += nbytes
+
+        lower, upper = self._bounds()
+        if len(self.samples) >= self.MIN_SAMPLES and upper < self.min_kbps:
+            return self.FAIL
+        if self.total_bytes >= self.max_bytes:
+            return self.finish()
+        if self.total_bytes >= self.base_bytes and lower < self.min_kbps * self.PROMISING_FACTOR:
+            return self.finish()
+        return self.CONTINUE
+
+    def finish(self) -> str:
+        return self.PASS if self.total_bytes >= self.base_bytes and self.kbps >= self.min_kbps else self.FAIL
+
+
+class BandwidthLease:
+    def __init__(self, admitted_bytes: int, contention: int):
+        self.admitted_bytes = admitted_bytes
+        self.used_bytes = 0
+        self.contention = contention
+
+
+class BandwidthScheduler:
+    """Scan-wide token bucket shared by the speed and Xray stages.
+
+    A measurement is admitted once the bucket holds enough tokens for its base
+    download; whatever it pulls beyond that is charged on release (and unused
+    tokens are refunded), so later admissions back off while the link is busy.
+    Each lease remembers the peak number of concurrent measurements it ran
+    alongside, which is reported as its contention level.
+    """
+
+    def __init__(self, rate_bytes_per_sec: float, burst_bytes: int):
+        self.rate = rate_bytes_per_sec
+        self.capacity = max(burst_bytes, int(rate_bytes_per_sec))
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self.active = set()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def admit(self, nbytes: int) -> BandwidthLease:
+        if self.rate > 0:
+            async with self._lock:
+                self._refill()
+                while self.tokens < nbytes:
+                    await asyncio.sleep((nbytes - self.tokens) / self.rate)
+                    self._refill()
+                self.tokens -= nbytes
+
+        lease = BandwidthLease(nbytes, len(self.active) + 1)
+        self.active.add(lease)
+        for other in self.active:
+            other.contention = max(other.contention, len(self.active))
+        return lease
+
+    def release(self, lease: BandwidthLease):
+        if lease not in self.active: return
+        self.active.discard(lease)
+        if self.rate > 0:
+            self._refill()
+            self.tokens = min(self.capacity, self.tokens + lease.admitted_bytes - lease.used_bytes)
+
+
+def has_ipv6_route(probe_addr: str = "2606:4700:4700::1111") -> bool:
+    """Asks the kernel for a route to a Cloudflare IPv6 address. Connecting a UDP socket sends no packets."""
+    try:
+        with socket.socket(socket.AF_INET6, socket.SOCK_DGRAM) as sock:
+            sock.connect((probe_addr, 443))
+            source = ipaddress.ip_address(sock.getsockname()[0].split('%')[0])
+    except (OSError, ValueError):
+        return False
+    return not (source.is_link_local or source.is_loopback)
+
+
+class FamilyMix:
+    """Splits candidate generation between address families by measured Stage 1 yield.
+
+    Every family keeps decayed counts of probes, opened endpoints and the
+    seconds its probes held a worker. Its share of new candidates follows
+    opens per probe-second, so a family whose probes time out loses share
+    faster than one that is refused quickly. A floor keeps every enabled
+    family sampled so the mix can recover when its network does.
+    """
+
+    DECAY = 0.995
+    FLOOR = 0.1
+
+    def __init__(self, families):
+        self.families = sorted(families)
+        # Even prior (one open per two probe-seconds) so neither family starts ahead.
+        self.stats = {family: [2.0, 1.0, 2.0] for family in self.families}
+
+    def shares(self) -> dict:
+        if len(self.families) < 2: return {family: 1.0 for family in self.families}
+        yields = {family: opens / max(seconds, 1e-3) for family, (_, opens, seconds) in self.stats.items()}
+        total = sum(yields.values()) or 1.0
+        spread = 1.0 - self.FLOOR * len(self.families)
+        return {family: self.FLOOR + spread * value / total for family, value in yields.items()}
+
+    def choose(self) -> int:
+        if len(self.families) == 1: return self.families[0]
+        shares = self.shares()
+        return random.choices(list(shares), weights=list(shares.values()))[0]
+
+    def record(self, family: int, opened: bool, seconds: float):
+        if family not in self.stats: return
+        stats = self.stats[family]
+        for idx in range(3): stats[idx] *= self.DECAY
+        stats[0] += 1
+        stats[1] += 1 if opened else 0
+        stats[2] += seconds
+
+
+async def probe_tls_handshake(ip: str, port: int, sni: str, timeout: float = 3.0):
+    """Returns the TLS handshake time in ms, or None if the endpoint did not complete one."""
+    context = ssl.create_default_context()
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    try:
+        start_time = time.monotonic()
+        fut = asyncio.open_connection(ip, port, ssl=context, server_hostname=sni)
+        _, writer = await asyncio.wait_for(fut, timeout=timeout)
+        latency_ms = (time.monotonic() - start_time) * 1000
+        writer.close()
+        return latency_ms
+    except Exception:
+        return None
+
+
+async def probe_cf_signature(ip: str, port: int, sni: str, timeout: float = 2.0):
+    """Sends a bare GET over TLS and returns the round trip in ms if the reply carries Cloudflare's signature."""
+    context = ssl.create_default_context()
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    try:
+        start_time = time.monotonic()
+        fut = asyncio.open_connection(ip, port, ssl=context, server_hostname=sni)
+        reader, writer = await asyncio.wait_for(fut, timeout=timeout)
+
+        writer.write(f"GET / HTTP/1.1\r\nHost: {sni}\r\nConnection: close\r\n\r\n".encode())
+        await writer.drain()
+        response = await asyncio.wait_for(reader.read(1024), timeout=timeout)
+        writer.close()
+        await writer.wait_closed()
+
+        latency_ms = (time.monotonic() - start_time) * 1000
+        if b"cloudflare" in response.lower() or b"403 Forbidden" in response: return latency_ms
+    except Exception:
+        pass
+    return None
+
+
+# CAs Cloudflare issues its edge certificates from (Universal, Advanced and Total TLS).
+CF_CERT_ISSUERS = ("Cloudflare", "Google Trust Services", "Let's Encrypt", "SSL Corporation", "Sectigo")
+
+
+def tls_trust_store_available() -> bool:
+    paths = ssl.get_default_verify_paths()
+    if ssl.create_default_context().cert_store_stats()["x509_ca"]: return True
+    if paths.cafile and os.path.exists(paths.cafile): return True
+    return bool(paths.capath and os.path.isdir(paths.capath) and os.listdir(paths.capath))
+
+
+async def inspect_tls_handshake(ip: str, port: int, sni: str, timeout: float = 2.0) -> dict:
+    """Completes a verified TLS handshake without sending a request and reports what the edge presented.
+
+    Returns None if the handshake fails or the certificate is not valid for
+    the SNI. A stale or off-Cloudflare domain fails here the same way the HTTP
+    check would.
+    """
+    context = ssl.create_default_context()
+    context.set_alpn_protocols(["h2", "http/1.1"])
+    try:
+        start_time = time.monotonic()
+        fut = asyncio.open_connection(ip, port, ssl=context, server_hostname=sni)
+        _, writer = await asyncio.wait_for(fut, timeout=timeout)
+        latency_ms = (time.monotonic() - start_time) * 1000
+    except Exception:
+        return None
+
+    try:
+        ssl_object = writer.get_extra_info("ssl_object")
+        cert = ssl_object.getpeercert() or {}
+        issuer = dict(field for rdn in cert.get("issuer", ()) for field in rdn).get("organizationName", "")
+        # TLS 1.3 tickets follow the handshake; report whether one has already been processed.
+        session = ssl_object.session
+        return {"latency_ms": latency_ms, "alpn": ssl_object.selected_alpn_protocol(), "issuer": issuer,
+                "san": [value for kind, value in cert.get("subjectAltName", ()) if kind == "DNS"],
+                "ticket": bool(session and session.has_ticket), "version": ssl_object.version()}
+    finally:
+        writer.close()
+
+
+def is_cf_handshake(info: dict) -> bool:
+    """A Cloudflare edge answers a proxied zone's SNI with a valid cert from one of its CAs and always offers h2."""
+    return bool(info) and info["alpn"] == "h2" and any(name in info["issuer"] for name in CF_CERT_ISSUERS)
+
+
+async def run_tls_benchmark(samples: int, port: int = 443):
+    """Compares the handshake-only verdict with the HTTP signature check on the same random endpoints."""
+    networks = []
+    if os.path.exists(IPV4_FILE):
+        with open(IPV4_FILE, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    networks.append(ipaddress.ip_network(line.strip(), strict=False))
+                except ValueError:
+                    pass
+    domains = []
+    if os.path.exists(DOMAINS_FILE):
+        with open(DOMAINS_FILE, 'r', encoding='utf-8') as f:
+            domains = [line.strip() for line in f if line.strip()]
+    if not networks or not domains:
+        print("❌ ipv4.txt and cloudflare-domains.txt are required for the TLS benchmark.")
+        return
+    if not tls_trust_store_available():
+        print("⚠️ No CA trust store found. Handshake verification will reject every endpoint.")
+
+    print(f"Probing random endpoints on port {port} until {samples} accept TCP...")
+    endpoints = []
+    attempts = 0
+    while len(endpoints) < samples and attempts < samples * 50:
+        batch = []
+        for _ in range(min(200, samples * 50 - attempts)):
+            net = random.choice(networks)
+            batch.append(str(net[random.randint(1, net.num_addresses - 2)]))
+        attempts += len(batch)
+        opened = await asyncio.gather(*(probe_tcp_ports(ip, [port]) for ip in batch))
+        endpoints.extend(ip for ip, ports in zip(batch, opened) if ports)
+    endpoints = endpoints[:samples]
+    if not endpoints:
+        print("❌ No endpoint accepted TCP. Check your connection.")
+        return
+
+    rows = []
+    semaphore = asyncio.Semaphore(20)
+
+    async def measure(ip, flip):
+        sni = random.choice(domains)
+        async with semaphore:
+            probes = [("handshake", inspect_tls_handshake(ip, port, sni)), ("http", probe_cf_signature(ip, port, sni))]
+            outcome = {}
+            # Alternate the order so neither method consistently benefits from a warm path.
+            for name, coro in (reversed(probes) if flip else probes):
+                started = time.monotonic()
+                result = await coro
+                outcome[name] = (result, (time.monotonic() - started) * 1000)
+        rows.append((is_cf_handshake(outcome["handshake"][0]), outcome["handshake"][1],
+                     outcome["http"][0] is not None, outcome["http"][1], outcome["handshake"][0]))
+
+    await asyncio.gather(*(measure(ip, idx % 2) for idx, ip in enumerate(endpoints)))
+
+    def percentile(values, q):
+        return sorted(values)[min(len(values) - 1, int(q * len(values)))] if values else float("nan")
+
+    both = sum(1 for hs, _, http, _, _ in rows if hs and http)
+    hs_only = sum(1 for hs, _, http, _, _ in rows if hs and not http)
+    http_only = sum(1 for hs, _, http, _, _ in rows if http and not hs)
+    neither = len(rows) - both - hs_only - http_only
+    print(f"\nTLS verdict benchmark over {len(rows)} endpoints (HTTP check is the reference):")
+    print(f"  agree: {both + neither} ({(both + neither) / len(rows):.1%})  both pass: {both}  both fail: {neither}")
+    print(f"  handshake-only pass, HTTP fail: {hs_only}  HTTP pass, handshake-only fail: {http_only}")
+    print(f"{'Method':<12}{'p50 ms':>10}{'p90 ms':>10}{'p50 pass ms':>14}")
+    for label, ok_idx, ms_idx in (("handshake", 0, 1), ("http", 2, 3)):
+        all_ms = [row[ms_idx] for row in rows]
+        pass_ms = [row[ms_idx] for row in rows if row[ok_idx]]
+        print(f"{label:<12}{percentile(all_ms, 0.5):>10.0f}{percentile(all_ms, 0.9):>10.0f}"
+              f"{percentile(pass_ms, 0.5):>14.0f}")
+    infos = [row[4] for row in rows if row[4]]
+    if infos:
+        alpn = collections.Counter(info["alpn"] for info in infos)
+        tickets = sum(1 for info in infos if info["ticket"])
+        print(f"  ALPN: {dict(alpn)}  session ticket at handshake end: {tickets}/{len(infos)}")
+
+
+class SniReputation:
+    """Learns which SNI domains still get a Cloudflare answer and favours them in Stage 2.
+
+    Each domain keeps decayed hit/attempt counts. Its selection weight is the
+    square of its smoothed hit rate, so proven domains are picked far more
+    often than unknown ones while unknown ones are still explored. Domains that
+    keep failing are quarantined for a few hours and then return on probation
+    with halved counts. The table is persisted between runs.
+    """
+
+    DECAY = 0.98
+    QUARANTINE_MIN_ATTEMPTS = 8
+    QUARANTINE_BELOW = 0.1
+    QUARANTINE_SECONDS = 6 * 3600
+    REBUILD_EVERY = 100
+    SAVE_INTERVAL = 60
+
+    def __init__(self, domains: list, path: str):
+        self.domains = list(dict.fromkeys(domains))
+        self.path = path
+        self.scores = {}  # domain -> [hits, attempts, quarantined_until]
+        self.trusted = []
+        self.saved_at = time.monotonic()
+        self._load()
+        self._rebuild()
+
+    def _load(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        if not isinstance(data, dict): return
+        known = set(self.domains)
+        for domain, entry in data.items():
+            if domain in known and isinstance(entry, list) and len(entry) == 3:
+                try:
+                    self.scores[domain] = [float(value) for value in entry]
+                except (TypeError, ValueError):
+                    logging.error(f"Ignoring malformed SNI reputation entry for {domain}: {entry}")
+
+    def save(self):
+        tmp_path = self.path + ".tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(self.scores, f)
+            os.replace(tmp_path, self.path)
+            self.saved_at = time.monotonic()
+        except OSError as e:
+            logging.error(f"Failed to save SNI reputation: {e}")
+
+    def rate(self, domain: str) -> float:
+        hits, attempts, _ = self.scores.get(domain, (0.0, 0.0, 0.0))
+        return (hits + 1) / (attempts + 2)
+
+    def _rebuild(self):
+        now = time.time()
+        weights = []
+        for domain in self.domains:
+            entry = self.scores.get(domain)
+            if entry and entry[2]:
+                if entry[2] > now:
+                    weights.append(0.0)
+                    continue
+                entry[0], entry[1], entry[2] = entry[0] / 2, entry[1] / 2, 0.0
+            weights.append(self.rate(domain) ** 2)
+        if not any(weights): weights = [1.0] * len(self.domains)
+        self.cum_weights = list(itertools.accumulate(weights))
+
+        proven = [domain for domain, (_, attempts, quarantined) in self.scores.items() if attempts >= 3 and not quarantined]
+        self.trusted = sorted(proven, key=self.rate, reverse=True)[:10]
+        self.pending_updates = 0
+        if time.monotonic() - self.saved_at > self.SAVE_INTERVAL: self.save()
+
+    def choose(self) -> str:
+        return random.choices(self.domains, cum_weights=self.cum_weights)[0]
+
+    def known_good(self, exclude: str) -> str:
+        candidates = [domain for domain in self.trusted if domain != exclude and self.rate(domain) >= 0.5]
+        return random.choice(candidates) if candidates else None
+
+    def record(self, domain: str, success: bool):
+        entry = self.scores.setdefault(domain, [0.0, 0.0, 0.0])
+        entry[0] = entry[0] * self.DECAY + (1 if success else 0)
+        entry[1] = entry[1] * self.DECAY + 1
+        if not success and entry[1] >= self.QUARANTINE_MIN_ATTEMPTS and self.rate(domain) < self.QUARANTINE_BELOW:
+            entry[2] = time.time() + self.QUARANTINE_SECONDS
+            self._rebuild()
+            return
+        self.pending_updates += 1
+        if self.pending_updates >= self.REBUILD_EVERY: self._rebuild()
+
+    def quarantined_count(self) -> int:
+        now = time.time()
+        return sum(1 for _, _, until in self.scores.values() if until > now)
+
+
+def extract_share_links(text: str) -> list:
+    return [token for token in text.split() if token.startswith("vless://") or token.startswith("trojan://")]
+
+
+class XrayTemplate:
+    """A base config compiled once per scan for the Stage 4 hot path.
+
+    The Xray JSON is serialized a single time with placeholder tokens, so each
+    candidate only costs a str.format() call. The share link is split into a
+    prefix and suffix around the server endpoint for the same reason.
+    """
+
+    IP_TOKEN = "__WALDON_IP__"
+    PORT_TOKEN = "__WALDON_PORT__"
+    LOCAL_PORT_TOKEN = "__WALDON_LOCAL_PORT__"
+
+    def __init__(self, base_config: dict, base_uri: str, name: str):
+        self.name = name
+        config = copy.deepcopy(base_config)
+        config.pop("routing", None)
+        config.pop("dns", None)
+        config["inbounds"][0]["port"] = self.LOCAL_PORT_TOKEN
+        config["inbounds"][0]["protocol"] = "mixed"
+
+        outbound = config["outbounds"][0]
+        self.scheme = outbound["protocol"]
+        if self.scheme == "vless":
+            server = outbound["settings"]["vnext"][0]
+        elif self.scheme == "trojan":
+            server = outbound["settings"]["servers"][0]
+        else:
+            raise ValueError(f"Unsupported outbound protocol: {self.scheme}")
+        self.config_port, self.tls = outbound_endpoint(base_config)
+        server["address"] = self.IP_TOKEN
+        server["port"] = self.PORT_TOKEN
+
+        raw = json.dumps(config).replace("{", "{{").replace("}", "}}")
+        raw = raw.replace(f'"{self.LOCAL_PORT_TOKEN}"', "{local_port}").replace(f'"{self.PORT_TOKEN}"', "{port}")
+        self._config_format = raw.replace(self.IP_TOKEN, "{ip}")
+
+        parsed = urllib.parse.urlparse(base_uri.strip())
+        uuid, server_port = parsed.netloc.split("@", 1)
+        original_server = server_port.split(":")[0]
+
+        qs = urllib.parse.parse_qs(parsed.query, keep_blank_values=True)
+        params = {k: v[0] for k, v in qs.items()}
+
+        if not params.get("sni"): params["sni"] = original_server
+        self.sni = params["sni"]
+        if not params.get("host"): params["host"] = params["sni"]
+        if not params.get("fp"): params["fp"] = "chrome"
+
+        new_query = urllib.parse.urlencode(params, safe=":/,")
+        fragment = f"#{parsed.fragment}" if parsed.fragment else "#Verified"
+
+        self._uri_prefix = f"{parsed.scheme}://{uuid}@"
+        self._uri_suffix = f"?{new_query}{fragment}"
+        self.native = NativeVerifier.from_outbound(base_config["outbounds"][0])
+
+    def stage4_port(self, scanned_port: int, scan_ports: list) -> int:
+        """The port Stage 4 dials and exports.
+
+        A TLS config follows the port the IP was found on when the config's own
+        port is one of the scanned ones; otherwise, and always for plaintext
+        configs, the config's port is kept.
+        """
+        if self.tls and self.config_port in scan_ports: return scanned_port
+        return self.config_port or scanned_port
+
+    def render(self, ip: str, port: int, local_port: int) -> bytes:
+        return self._config_format.format(ip=ip, port=port, local_port=local_port).encode("utf-8")
+
+    def share_uri(self, ip: str, port: int) -> str:
+        formatted_ip = f"[{ip}]" if ":" in ip else ip
+        return f"{self._uri_prefix}{formatted_ip}:{port}{self._uri_suffix}"
+
+
+class NativeProxyError(Exception):
+    pass
+
+
+def _ws_frame(payload: bytes, opcode: int = 0x2) -> bytes:
+    """Builds one masked client WebSocket frame."""
+    size = len(payload)
+    if size < 126:
+        header = bytes([0x80 | opcode, 0x80 | size])
+    elif size < 65536:
+        header = bytes([0x80 | opcode, 0x80 | 126]) + size.to_bytes(2, "big")
+    else:
+        header = bytes([0x80 | opcode, 0x80 | 127]) + size.to_bytes(8, "big")
+    mask = os.urandom(4)
+    return header + mask + _ws_unmask(payload, mask)
+
+
+def _ws_unmask(payload: bytes, mask: bytes) -> bytes:
+    if not payload: return payload
+    key = (mask * (len(payload) // 4 + 1))[:len(payload)]
+    return (int.from_bytes(payload, "big") ^ int.from_bytes(key, "big")).to_bytes(len(payload), "big")
+
+
+class _ProxyTunnel:
+    """Byte pipe to the proxied target over a raw stream or WebSocket frames.
+
+    The VLESS/Trojan request header rides on the first write, as Xray sends it,
+    and the VLESS response header is stripped from the first bytes read.
+    """
+
+    def __init__(self, reader, writer, header: bytes, websocket: bool, vless: bool):
+        self.reader = reader
+        self.writer = writer
+        self.header = header
+        self.websocket = websocket
+        self.vless_pending = vless
+        self.vless_buffer = b""
+
+    async def send(self, data: bytes):
+        if self.header:
+            data, self.header = self.header + data, b""
+        self.writer.write(_ws_frame(data) if self.websocket else data)
+        await self.writer.drain()
+
+    async def _read_frame(self) -> bytes:
+        if not self.websocket: return await self.reader.read(65536)
+        while True:
+            head = await self.reader.readexactly(2)
+            opcode, size = head[0] & 0x0F, head[1] & 0x7F
+            if size == 126: size = int.from_bytes(await self.reader.readexactly(2), "big")
+            elif size == 127: size = int.from_bytes(await self.reader.readexactly(8), "big")
+            mask = await self.reader.readexactly(4) if head[1] & 0x80 else None
+            payload = await self.reader.readexactly(size)
+            if mask: payload = _ws_unmask(payload, mask)
+            if opcode == 0x8: return b""
+            if opcode == 0x9:
+                self.writer.write(_ws_frame(payload, opcode=0xA))
+            elif opcode in (0x0, 0x1, 0x2) and payload:
+                return payload
+
+    async def recv(self) -> bytes:
+        while True:
+            data = await self._read_frame()
+            if not self.vless_pending or not data: return data
+            self.vless_buffer += data
+            if len(self.vless_buffer) < 2 or len(self.vless_buffer) < 2 + self.vless_buffer[1]: continue
+            if self.vless_buffer[0] != 0: raise NativeProxyError("unexpected VLESS response version")
+            data = self.vless_buffer[2 + self.vless_buffer[1]:]
+            self.vless_pending, self.vless_buffer = False, b""
+            if data: return data
+
+
+class _TunnelTLS:
+    """TLS to the speed-test host, run over a tunnel through MemoryBIOs (TLS inside the proxy's TLS)."""
+
+    def __init__(self, tunnel: _ProxyTunnel, server_hostname: str):
+        context = ssl.create_default_context()
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+        context.set_alpn_protocols(["http/1.1"])
+        self.tunnel = tunnel
+        self.incoming = ssl.MemoryBIO()
+        self.outgoing = ssl.MemoryBIO()
+        self.ssl_object = context.wrap_bio(self.incoming, self.outgoing, server_hostname=server_hostname)
+
+    async def _flush(self):
+        data = self.outgoing.read()
+        if data: await self.tunnel.send(data)
+
+    async def _fill(self) -> bool:
+        data = await self.tunnel.recv()
+        if not data: return False
+        self.incoming.write(data)
+        return True
+
+    async def handshake(self):
+        while True:
+            try:
+                self.ssl_object.do_handshake()
+                await self._flush()
+                return
+            except ssl.SSLWantReadError:
+                await self._flush()
+                if not await self._fill(): raise NativeProxyError("tunnel closed during the inner TLS handshake")
+
+    async def send(self, data: bytes):
+        self.ssl_object.write(data)
+        await self._flush()
+
+    async def recv(self) -> bytes:
+        while True:
+            try:
+                return self.ssl_object.read(65536)
+            except ssl.SSLWantReadError:
+                await self._flush()
+                if not await self._fill(): return b""
+            except ssl.SSLZeroReturnError:
+                return b""
+
+
+class NativeResponse:
+    """The part of aiohttp's ClientResponse that Stage 4 reads: `status` and `content.iter_any()`."""
+
+    def __init__(self, status: int, first_chunk: bytes, tls: _TunnelTLS, timeout: float):
+        self.status = status
+        self.content = self
+        self._first_chunk = first_chunk
+        self._tls = tls
+        self._timeout = timeout
+
+    async def iter_any(self):
+        if self._first_chunk: yield self._first_chunk
+        while True:
+            chunk = await asyncio.wait_for(self._tls.recv(), timeout=self._timeout)
+            if not chunk: return
+            yield chunk
+
+
+class NativeVerifier:
+    """In-process Stage 4 for the common outbounds: VLESS or Trojan over TCP+TLS or WebSocket.
+
+    Speaks the proxy header directly on an asyncio connection to the edge and
+    fetches the speed payload through the tunnel over its own TLS session, so
+    a check needs no Xray process and no local port. Outbounds it does not
+    cover (REALITY, XTLS flows, gRPC, xhttp, ...) return None from
+    from_outbound() and stay on the Xray path.
+    """
+
+    TARGET_HOST = "speed.cloudflare.com"
+    TARGET_PORT = 443
+
+    def __init__(self, protocol: str, secret: bytes, tls: bool, sni: str, alpn: list, ws_path: str, ws_host: str,
+                 fingerprint: str = ""):
+        self.protocol = protocol
+        self.fingerprint = fingerprint
+        self.secret = secret
+        self.tls = tls
+        self.sni = sni
+        self.alpn = alpn
+        self.ws_path = ws_path
+        self.ws_host = ws_host
+
+    @classmethod
+    def from_outbound(cls, outbound: dict):
+        try:
+            protocol = outbound["protocol"]
+            stream = outbound.get("streamSettings", {})
+            network = stream.get("network", "tcp")
+            security = stream.get("security", "none")
+            if network not in ("tcp", "raw", "ws") or security not in ("tls", "none"): return None
+            if stream.get("tcpSettings", {}).get("header", {}).get("type", "none") != "none": return None
+
+            if protocol == "vless":
+                server = outbound["settings"]["vnext"][0]
+                user = server["users"][0]
+                if user.get("flow") or user.get("encryption", "none") != "none": return None
+                try:
+                    secret = uuid.UUID(user["id"]).bytes
+                except ValueError:
+                    # Xray maps short non-UUID ids with UUIDv5 in the nil namespace.
+                    secret = uuid.uuid5(uuid.UUID(int=0), user["id"]).bytes
+            elif protocol == "trojan":
+                server = outbound["settings"]["servers"][0]
+                secret = hashlib.sha224(server["password"].encode("utf-8")).hexdigest().encode("ascii")
+            else:
+                return None
+
+            tls_settings = stream.get("tlsSettings", {})
+            sni = tls_settings.get("serverName") or server["address"]
+            ws_path, ws_host = None, None
+            if network == "ws":
+                ws = stream.get("wsSettings", {})
+                parsed = urllib.parse.urlsplit(ws.get("path") or "/")
+                # ?ed= asks the client to use early data; it is not part of the path the server matches.
+                query = urllib.parse.urlencode([(k, v) for k, v in urllib.parse.parse_qsl(parsed.query) if k != "ed"])
+                ws_path = (parsed.path or "/") + (f"?{query}" if query else "")
+                ws_host = ws.get("host") or ws.get("headers", {}).get("Host") or sni
+                alpn = ["http/1.1"]
+            else:
+                alpn = tls_settings.get("alpn") or []
+            # The ClientHello is Python's own; a uTLS fingerprint is remembered so callers can prefer Xray.
+            fingerprint = tls_settings.get("fingerprint", "") if security == "tls" else ""
+            return cls(protocol, secret, security == "tls", sni, alpn, ws_path, ws_host, fingerprint)
+        except (KeyError, IndexError, TypeError, ValueError, AttributeError):
+            return None
+
+    def _request_header(self) -> bytes:
+        host = self.TARGET_HOST.encode("ascii")
+        port = self.TARGET_PORT.to_bytes(2, "big")
+        if self.protocol == "vless":
+            return b"\x00" + self.secret + b"\x00\x01" + port + b"\x02" + bytes([len(host)]) + host
+        return self.secret + b"\r\n\x01\x03" + bytes([len(host)]) + host + port + b"\r\n"
+
+    async def _connect(self, ip: str, port: int):
+        context = None
+        if self.tls:
+            context = ssl.create_default_context()
+            context.check_hostname = False
+            context.verify_mode = ssl.CERT_NONE
+            if self.alpn: context.set_alpn_protocols(self.alpn)
+        return await asyncio.open_connection(ip, port, ssl=context, server_hostname=self.sni if context else None)
+
+    async def _request(self, reader, writer, path: str, timeout: float) -> NativeResponse:
+        if self.ws_path is not None:
+            key = base64.b64encode(os.urandom(16)).decode("ascii")
+            writer.write((f"GET {self.ws_path} HTTP/1.1\r\nHost: {self.ws_host}\r\nUser-Agent: Mozilla/5.0\r\n"
+                          f"Upgrade: websocket\r\nConnection: Upgrade\r\nSec-WebSocket-Key: {key}\r\n"
+                          f"Sec-WebSocket-Version: 13\r\n\r\n").encode("utf-8"))
+            await writer.drain()
+            status_line = await reader.readline()
+            if b" 101 " not in status_line:
+                raise NativeProxyError(f"WebSocket upgrade refused: {status_line.decode('latin-1').strip()}")
+            while (await reader.readline()).strip():
+                pass
+
+        tunnel = _ProxyTunnel(reader, writer, self._request_header(), self.ws_path is not None, self.protocol == "vless")
+        tls = _TunnelTLS(tunnel, self.TARGET_HOST)
+        await tls.handshake()
+        await tls.send((f"GET {path} HTTP/1.1\r\nHost: {self.TARGET_HOST}\r\nUser-Agent: Mozilla/5.0\r\n"
+                        f"Connection: close\r\n\r\n").encode("utf-8"))
+
+        buffer = b""
+        while b"\r\n\r\n" not in buffer:
+            chunk = await tls.recv()
+            if not chunk: raise NativeProxyError("tunnel closed before the response headers")
+            buffer += chunk
+        head, body = buffer.split(b"\r\n\r\n", 1)
+        try:
+            status = int(head.split(b" ", 2)[1])
+        except (IndexError, ValueError):
+            raise NativeProxyError("malformed response through the tunnel")
+        return NativeResponse(status, body, tls, timeout)
+
+    @contextlib.asynccontextmanager
+    async def get(self, ip: str, port: int, path: str, timeout: float = 10.0):
+        reader, writer = await asyncio.wait_for(self._connect(ip, port), timeout=timeout)
+        try:
+            yield await asyncio.wait_for(self._request(reader, writer, path, timeout), timeout=timeout)
+        finally:
+            writer.close()
+
+
+class ControlServer:
+    """Optional localhost HTTP API for driving the scanner from other tools.
+
+    It shares the UI's event loop, and every handler only flips state or reads
+    snapshots, so the probe workers never wait on it. Event subscribers get a
+    bounded queue each; a slow client loses events instead of stalling the scan.
+
+    Requests must name the loopback address in Host and, when a browser sends
+    one, in Origin, which shuts out DNS-rebinding and cross-site pages. With a
+    token, every request also has to carry it as a Bearer header or ?token=.
+    """
+
+    def __init__(self, scanner, host: str, port: int, token: str = None):
+        self.scanner = scanner
+        self.host = host
+        self.port = port
+        self.token = token
+        self.subscribers = set()
+        self.runner = None
+
+    def _reject(self, request):
+        hosts = {f"127.0.0.1:{self.port}", f"localhost:{self.port}"}
+        if request.host not in hosts:
+            return self._json({"error": "unexpected Host header"}, status=403)
+        origin = request.headers.get("Origin")
+        if origin is not None and origin not in {f"http://{host}" for host in hosts}:
+            return self._json({"error": "cross-origin requests are not allowed"}, status=403)
+        if self.token:
+            supplied = request.headers.get("Authorization", "").removeprefix("Bearer ") or request.query.get("token", "")
+            if not hmac.compare_digest(supplied.encode("utf-8"), self.token.encode("utf-8")):
+                return self._json({"error": "missing or wrong token"}, status=401)
+        return None
+
+    async def start(self):
+        from aiohttp import web
+
+        @web.middleware
+        async def guard(request, handler):
+            rejected = self._reject(request)
+            return rejected if rejected is not None else await handler(request)
+
+        app = web.Application(middlewares=[guard])
+        app.router.add_get("/status", self._status)
+        app.router.add_post("/start", self._start)
+        app.router.add_post("/pause", self._pause)
+        app.router.add_post("/resume", self._resume)
+        app.router.add_post("/stop", self._stop)
+        app.router.add_get("/settings", self._get_settings)
+        app.router.add_post("/settings", self._set_settings)
+        app.router.add_get("/results", self._results)
+        app.router.add_get("/events", self._events)
+        app.router.add_get("/sub", self._subscription)
+
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, self.host, self.port).start()
+
+    async def stop(self):
+        if self.runner: await self.runner.cleanup()
+
+    def publish(self, event: str, data: dict):
+        for queue in list(self.subscribers):
+            try:
+                queue.put_nowait((event, data))
+            except asyncio.QueueFull:
+                pass
+
+    def _json(self, data, status: int = 200):
+        from aiohttp import web
+        return web.json_response(data, status=status)
+
+    async def _status(self, request):
+        return self._json(self.scanner.status_snapshot())
+
+    async def _start(self, request):
+        if self.scanner.is_scanning: return self._json({"error": "already scanning"}, status=409)
+        self.scanner.action_start_scan()
+        return self._json(self.scanner.status_snapshot())
+
+    async def _pause(self, request):
+        if not self.scanner.is_scanning: return self._json({"error": "not scanning"}, status=409)
+        self.scanner.action_pause_scan()
+        return self._json(self.scanner.status_snapshot())
+
+    async def _resume(self, request):
+        if not self.scanner.is_scanning: return self._json({"error": "not scanning"}, status=409)
+        self.scanner.action_resume_scan()
+        return self._json(self.scanner.status_snapshot())
+
+    async def _stop(self, request):
+        if not self.scanner.is_scanning: return self._json({"error": "not scanning"}, status=409)
+        self.scanner.action_stop_scan()
+        return self._json(self.scanner.status_snapshot())
+
+    async def _get_settings(self, request):
+        return self._json(self.scanner.settings_snapshot())
+
+    async def _set_settings(self, request):
+        if request.content_type != "application/json":
+            return self._json({"error": "expected a JSON body (Content-Type: application/json)"}, status=415)
+        try:
+            body = await request.json()
+            self.scanner.apply_settings(body)
+        except (ValueError, TypeError) as e:
+            return self._json({"error": str(e)}, status=400)
+        return self._json(self.scanner.settings_snapshot())
+
+    async def _results(self, request):
+        return self._json(self.scanner.results_snapshot())
+
+    async def _subscription(self, request):
+        from aiohttp import web
+        links = "\n".join(row["uri"] for row in self.scanner.results_snapshot())
+        if request.query.get("format") == "plain": return web.Response(text=links)
+        return web.Response(text=base64.b64encode(links.encode("utf-8")).decode("ascii"))
+
+    async def _events(self, request):
+        from aiohttp import web
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache"})
+        await response.prepare(request)
+        queue = asyncio.Queue(maxsize=256)
+        self.subscribers.add(queue)
+        try:
+            await response.write(f"event: status\ndata: {json.dumps(self.scanner.status_snapshot())}\n\n".encode())
+            while True:
+                try:
+                    event, data = await asyncio.wait_for(queue.get(), timeout=15)
+                    await response.write(f"event: {event}\ndata: {json.dumps(data)}\n\n".encode())
+                except asyncio.TimeoutError:
+                    await response.write(b": keep-alive\n\n")
+        except (ConnectionResetError, asyncio.CancelledError):
+            pass
+        finally:
+            self.subscribers.discard(queue)
+        return response
+
+
+SUBNET_STAGES = ("probed", "tcp_open", "tls_ok", "speed_ok", "verified")
+PROTOCOL_LIMIT = 16 * 1024 * 1024
+
+
+def subnet_key(ip: str) -> str:
+    return str(ipaddress.ip_network(f"{ip}/{24 if '.' in ip else 48}", strict=False))
+
+
+def build_shards(shard_size: int) -> list:
+    shards = []
+    for file_path in [IPV4_FILE, IPV6_FILE]:
+        if not os.path.exists(file_path): continue
+        networks = []
+        with open(file_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    networks.append(str(ipaddress.ip_network(line.strip(), strict=False)))
+                except ValueError:
+                    pass
+        shards.extend(networks[i:i + shard_size] for i in range(0, len(networks), shard_size))
+    return shards
+
+
+def iter_shard_addresses(networks: list, v6_samples: int):
+    """Yields every IPv4 host of the shard in random order, plus a random sample from each IPv6 network."""
+    v4_hosts = []
+    v6_nets = []
+    for cidr in networks:
+        net = ipaddress.ip_network(cidr, strict=False)
+        if net.version == 4:
+            base = int(net.network_address)
+            v4_hosts.extend(range(base + 1, base + net.num_addresses - 1))
+        else:
+            v6_nets.append(net)
+    random.shuffle(v4_hosts)
+    for value in v4_hosts:
+        yield str(ipaddress.IPv4Address(value))
+    for _ in range(v6_samples):
+        for net in v6_nets:
+            yield str(ipaddress.IPv6Address(int(net.network_address) + random.getrandbits(128 - net.prefixlen)))
+
+
+async def read_message(reader) -> dict:
+    line = await reader.readline()
+    return json.loads(line) if line else None
+
+
+def send_message(writer, message: dict):
+    writer.write(json.dumps(message).encode("utf-8") + b"\n")
+
+
+class ShardCoordinator:
+    """Hands address shards to remote workers and merges what they find.
+
+    Workers speak newline-delimited JSON over TCP. A shard is leased to one
+    worker at a time; the lease is renewed by heartbeats and goes back to the
+    queue if it expires or the worker disconnects, so a dead machine only costs
+    a re-scan of the shard it was holding.
+    """
+
+    LEASE_TTL = 60
+
+    def __init__(self, host: str, port: int, shards: list, configs: list, ports: str, v6_samples: int, token: str):
+        self.host = host
+        self.port = port
+        self.token = token
+        self.shards = shards
+        self.configs = configs
+        self.ports = ports
+        self.v6_samples = v6_samples
+        self.needs_ipv6 = [any(":" in cidr for cidr in shard) for shard in shards]
+        self.pending = collections.deque(range(len(shards)))
+        self.leases = {}
+        self.completed = set()
+        self.results = {}
+        self.subnets = {}
+        self.workers = set()
+        self.done_event = asyncio.Event()
+
+    async def serve(self):
+        server = await asyncio.start_server(self._handle_worker, self.host, self.port, limit=PROTOCOL_LIMIT)
+        print(f"📡 Coordinator listening on {self.host}:{self.port} with {len(self.shards)} shards.")
+        reaper = asyncio.create_task(self._reap_expired_leases())
+        try:
+            async with server:
+                await self.done_event.wait()
+                for writer in list(self.workers):
+                    try:
+                        send_message(writer, {"type": "done"})
+                        await writer.drain()
+                    except ConnectionError:
+                        pass
+        finally:
+            reaper.cancel()
+            self._write_outputs()
+        print(f"✅ All shards complete. {len(self.results)} verified results written to {DIST_RESULTS_FILE}")
+
+    def _next_lease(self, worker_id: str, ipv6: bool = True) -> dict:
+        # Workers without an IPv6 route would report every IPv6 network as unreachable, so they only get IPv4 shards.
+        for _ in range(len(self.pending)):
+            shard_id = self.pending.popleft()
+            if shard_id in self.completed: continue
+            if self.needs_ipv6[shard_id] and not ipv6:
+                self.pending.append(shard_id)
+                continue
+            self.leases[shard_id] = (worker_id, time.monotonic() + self.LEASE_TTL)
+            return {"type": "lease", "shard": shard_id, "networks": self.shards[shard_id], "ttl": self.LEASE_TTL}
+        return None
+
+    def _requeue_worker_leases(self, worker_id: str):
+        for shard_id, (owner, _) in list(self.leases.items()):
+            if owner == worker_id:
+                del self.leases[shard_id]
+                self.pending.appendleft(shard_id)
+
+    def _release_shard(self, worker_id: str, shard_id: int):
+        lease = self.leases.get(shard_id)
+        if not lease or lease[0] != worker_id: return
+        del self.leases[shard_id]
+        self.pending.appendleft(shard_id)
+        print(f"↩️ Shard {shard_id} handed back unfinished by {worker_id}. Re-queued.")
+
+    async def _reap_expired_leases(self):
+        while True:
+            await asyncio.sleep(5)
+            now = time.monotonic()
+            for shard_id, (owner, expires) in list(self.leases.items()):
+                if expires < now:
+                    print(f"⚠️ Lease on shard {shard_id} held by {owner} expired. Re-issuing.")
+                    del self.leases[shard_id]
+                    self.pending.appendleft(shard_id)
+
+    def _merge_shard(self, worker_id: str, message: dict):
+        shard_id = message["shard"]
+        lease = self.leases.get(shard_id)
+        if not lease or lease[0] != worker_id:
+            print(f"⚠️ Ignoring results for shard {shard_id} from {worker_id}: it does not hold the lease.")
+            return
+        self.completed.add(shard_id)
+        self.leases.pop(shard_id, None)
+
+        for row in message.get("results", []):
+            key = (row["ip"], row["port"], row["config"])
+            if key not in self.results or row["score"] > self.results[key]["score"]:
+                self.results[key] = dict(row, worker=worker_id)
+        for subnet, counts in message.get("subnets", {}).items():
+            totals = self.subnets.setdefault(subnet, [0] * len(SUBNET_STAGES))
+            for idx, count in enumerate(counts):
+                totals[idx] += count
+
+        print(f"🧩 Shard {shard_id} done by {worker_id} ({len(self.completed)}/{len(self.shards)}, "
+              f"{len(self.results)} verified)")
+        self._write_outputs()
+        if len(self.completed) == len(self.shards): self.done_event.set()
+
+    async def _handle_worker(self, reader, writer):
+        peer = writer.get_extra_info("peername")
+        worker_id = f"{peer[0]}:{peer[1]}" if peer else "worker"
+        try:
+            hello = await read_message(reader)
+            if not hello or hello.get("type") != "hello": return
+            # The welcome carries the share links, so nothing is sent before the token checks out.
+            if not hmac.compare_digest(str(hello.get("token", "")).encode("utf-8"), self.token.encode("utf-8")):
+                print(f"⛔ Rejected {worker_id}: wrong or missing token.")
+                send_message(writer, {"type": "rejected"})
+                await writer.drain()
+                return
+            worker_id = hello.get("worker") or worker_id
+            ipv6 = bool(hello.get("ipv6", True))
+            print(f"👷 Worker connected: {worker_id}{'' if ipv6 else ' (IPv4 only)'}")
+            self.workers.add(writer)
+            send_message(writer, {"type": "welcome", "configs": self.configs, "ports": self.ports,
+                                  "v6_samples": self.v6_samples})
+            await writer.drain()
+
+            while True:
+                message = await read_message(reader)
+                if message is None: break
+                kind = message.get("type")
+                if kind == "ready":
+                    lease = self._next_lease(worker_id, ipv6)
+                    if lease:
+                        send_message(writer, lease)
+                    elif len(self.completed) == len(self.shards):
+                        send_message(writer, {"type": "done"})
+                    else:
+                        send_message(writer, {"type": "idle", "retry": 5})
+                elif kind == "heartbeat":
+                    lease = self.leases.get(message.get("shard"))
+                    if lease and lease[0] == worker_id:
+                        self.leases[message["shard"]] = (worker_id, time.monotonic() + self.LEASE_TTL)
+                elif kind == "complete":
+                    self._merge_shard(worker_id, message)
+                elif kind == "release":
+                    self._release_shard(worker_id, message.get("shard"))
+                await writer.drain()
+        except (ConnectionError, ValueError, KeyError) as e:
+            logging.error(f"Coordinator lost worker {worker_id}: {e}")
+        finally:
+            self.workers.discard(writer)
+            self._requeue_worker_leases(worker_id)
+            print(f"👋 Worker disconnected: {worker_id}")
+            writer.close()
+
+    def _write_outputs(self):
+        try:
+            ranked = sorted(self.results.values(), key=lambda row: row["score"], reverse=True)
+            with open(DIST_RESULTS_FILE, "w", newline="", encoding="utf-8") as f:
+                writer = csv.writer(f)
+                writer.writerow(["Rank", "IP Address", "Port", "Config", "Speed (KB/s)", "TLS Latency (ms)",
+                                 "TTFB (ms)", "Quality Score", "Subnet", "Worker", "URI"])
+                for idx, row in enumerate(ranked):
+                    writer.writerow([idx + 1, row["ip"], row["port"], row["config"], row["speed_kbps"],
+                                     row["tls_ms"], row["ttfb_ms"], row["score"], subnet_key(row["ip"]),
+                                     row["worker"], row["uri"]])
+
+            def subnet_rank(item):
+                counts = item[1]
+                return counts[4], counts[2] / max(counts[0], 1)
+
+            with open(DIST_SUBNETS_FILE, "w", newline="", encoding="utf-8") as f:
+                writer = csv.writer(f)
+                writer.writerow(["Subnet"] + [stage.replace("_", " ").title() for stage in SUBNET_STAGES] +
+                                ["TLS Pass Rate"])
+                for subnet, counts in sorted(self.subnets.items(), key=subnet_rank, reverse=True):
+                    writer.writerow([subnet] + counts + [f"{counts[2] / max(counts[0], 1):.3f}"])
+        except Exception as e:
+            logging.error(f"Failed to write distributed results: {e}")
+
+
+class ShardWorkerClient:
+    """Connects a headless scanner to a coordinator and scans the shards it is leased."""
+
+    HEARTBEAT_INTERVAL = 10
+
+    def __init__(self, scanner, host: str, port: int, token: str = None):
+        self.scanner = scanner
+        self.host = host
+        self.port = port
+        self.token = token or ""
+        self.worker_id = f"{platform.node()}-{os.getpid()}"
+
+    async def _heartbeat(self, writer, shard_id: int):
+        while True:
+            await asyncio.sleep(self.HEARTBEAT_INTERVAL)
+            send_message(writer, {"type": "heartbeat", "shard": shard_id})
+            await writer.drain()
+
+    async def run(self):
+        ipv6 = await asyncio.to_thread(has_ipv6_route)
+        if not ipv6: self.scanner.log_view.write("[yellow]No IPv6 route: asking the coordinator for IPv4 shards only.[/yellow]")
+        while True:
+            try:
+                reader, writer = await asyncio.open_connection(self.host, self.port, limit=PROTOCOL_LIMIT)
+            except OSError as e:
+                logging.error(f"Worker cannot reach coordinator {self.host}:{self.port}: {e}")
+                await asyncio.sleep(5)
+                continue
+
+            try:
+                send_message(writer, {"type": "hello", "worker": self.worker_id, "ipv6": ipv6, "token": self.token})
+                await writer.drain()
+                welcome = await read_message(reader)
+                if not welcome: raise ConnectionError("coordinator closed the connection")
+                if welcome["type"] == "rejected":
+                    logging.error("Coordinator rejected this worker: wrong or missing --token.")
+                    self.scanner.exit(return_code=1, message="Coordinator rejected this worker: wrong or missing --token.")
+                    return
+                self.scanner.apply_worker_settings(welcome)
+
+                while True:
+                    send_message(writer, {"type": "ready"})
+                    await writer.drain()
+                    message = await read_message(reader)
+                    if message is None: raise ConnectionError("coordinator closed the connection")
+                    if message["type"] == "done":
+                        logging.info("Coordinator reports all shards complete.")
+                        self.scanner.exit()
+                        return
+                    if message["type"] == "idle":
+                        await asyncio.sleep(message.get("retry", 5))
+                        continue
+
+                    heartbeat = asyncio.create_task(self._heartbeat(writer, message["shard"]))
+                    try:
+                        results, subnets, complete = await self.scanner.run_shard(message["networks"],
+                                                                                  welcome.get("v6_samples", 0))
+                    finally:
+                        heartbeat.cancel()
+                    if not complete:
+                        # Stopped early (byte budget, /stop, ...): hand the shard back rather than mark it swept.
+                        send_message(writer, {"type": "release", "shard": message["shard"]})
+                        await writer.drain()
+                        # A headless worker has nothing left to do once it stops taking shards.
+                        logging.info(f"Scan stopped early. Shard {message['shard']} returned to the coordinator.")
+                        self.scanner.exit(message=f"Scan stopped early. Shard {message['shard']} returned to the coordinator.")
+                        return
+                    send_message(writer, {"type": "complete", "shard": message["shard"], "results": results,
+                                          "subnets": subnets})
+            except (ConnectionError, ValueError, KeyError) as e:
+                logging.error(f"Worker connection to coordinator failed: {e}")
+                await asyncio.sleep(5)
+            finally:
+                writer.close()
+
+
+class LatencyMap:
+    """Every probe result of a full sweep, stored column-wise.
+
+    Each IPv4 host of the swept networks has a fixed row derived from its
+    address. Recording a result is a bisect over the network starts, with no
+    per-address index. Each IPv6 network contributes `v6_samples` random
+    addresses, and only those rows keep an address lookup. The columns are
+    `array` buffers of 9 bytes per address. When NumPy is installed, the
+    per-subnet aggregation reads them without copying and the map is also
+    exported as .npz.
+    """
+
+    def __init__(self, networks: list, v6_samples: int):
+        self.v4_starts = array('Q')
+        self.v4_offsets = array('Q', [0])
+        last_end = -1
+        for net in sorted((net for net in networks if net.version == 4), key=lambda net: int(net.network_address)):
+            first_host = int(net.network_address) + 1
+            hosts = max(0, net.num_addresses - 2)
+            if not hosts or first_host <= last_end: continue  # overlapping entries would share rows
+            self.v4_starts.append(first_host)
+            self.v4_offsets.append(self.v4_offsets[-1] + hosts)
+            last_end = first_host + hosts - 1
+        self.v4_rows = self.v4_offsets[-1]
+
+        self.v6_hi = array('Q')
+        self.v6_lo = array('Q')
+        self.v6_index = {}
+        for net in (net for net in networks if net.version == 6):
+            for _ in range(v6_samples):
+                address = int(net.network_address) + random.getrandbits(128 - net.prefixlen)
+                text = str(ipaddress.IPv6Address(address))
+                if text in self.v6_index: continue
+                self.v6_index[text] = self.v4_rows + len(self.v6_hi)
+                self.v6_hi.append(address >> 64)
+                self.v6_lo.append(address & 0xFFFFFFFFFFFFFFFF)
+
+        self.size = self.v4_rows + len(self.v6_hi)
+        self.tcp_ms = array('f', [math.nan]) * self.size
+        self.tls_ms = array('f', [math.nan]) * self.size
+        self.stage = array('b', [-1]) * self.size  # -1 = not probed yet, otherwise the last SUBNET_STAGES index reached
+        self.probed = 0
+
+    def address_int(self, row: int) -> int:
+        if row >= self.v4_rows:
+            return (self.v6_hi[row - self.v4_rows] << 64) | self.v6_lo[row - self.v4_rows]
+        idx = bisect.bisect_right(self.v4_offsets, row) - 1
+        return self.v4_starts[idx] + row - self.v4_offsets[idx]
+
+    def address(self, row: int) -> str:
+        value = self.address_int(row)
+        return str(ipaddress.IPv6Address(value) if row >= self.v4_rows else ipaddress.IPv4Address(value))
+
+    def addresses(self):
+        order = array('I', range(self.size))
+        random.shuffle(order)
+        for row in order:
+            yield self.address(row)
+
+    def row_of(self, ip: str):
+        if ':' in ip: return self.v6_index.get(ip)
+        value = int(ipaddress.IPv4Address(ip))
+        idx = bisect.bisect_right(self.v4_starts, value) - 1
+        if idx < 0: return None
+        offset = value - self.v4_starts[idx]
+        return self.v4_offsets[idx] + offset if offset < self.v4_offsets[idx + 1] - self.v4_offsets[idx] else None
+
+    def record(self, ip: str, stage: int, rtt_ms: float = None):
+        row = self.row_of(ip)
+        if row is None: return
+        if self.stage[row] < 0: self.probed += 1
+        if stage > self.stage[row]: self.stage[row] = stage
+        if rtt_ms is None: return
+        column = self.tcp_ms if stage == 1 else self.tls_ms if stage == 2 else None
+        if column is not None and not rtt_ms >= column[row]: column[row] = rtt_ms  # keep the best port's RTT
+
+    def _v4_addresses(self, np):
+        starts = np.frombuffer(self.v4_starts, dtype=np.uint64)
+        offsets = np.frombuffer(self.v4_offsets, dtype=np.uint64)
+        hosts = np.diff(offsets).astype(np.int64)
+        return np.repeat(starts, hosts) + (np.arange(self.v4_rows, dtype=np.uint64) - np.repeat(offsets[:-1], hosts))
+
+    def subnet_rows(self) -> list:
+        """Per /24 (IPv4) or /48 (IPv6): probed, reachable, TLS OK, verified, median TCP and TLS RTT."""
+        if importlib.util.find_spec("numpy") is None: return self._subnet_rows_python()
+        import numpy as np
+
+        stage = np.frombuffer(self.stage, dtype=np.int8)
+        tcp_ms = np.frombuffer(self.tcp_ms, dtype=np.float32)
+        tls_ms = np.frombuffer(self.tls_ms, dtype=np.float32)
+        v4_keys, v4_groups = np.unique(self._v4_addresses(np) >> np.uint64(8), return_inverse=True)
+        v6_keys, v6_groups = np.unique(np.frombuffer(self.v6_hi, dtype=np.uint64) >> np.uint64(16), return_inverse=True)
+        groups = np.concatenate([v4_groups, v6_groups + len(v4_keys)]).astype(np.int64)
+        n_groups = len(v4_keys) + len(v6_keys)
+
+        def counts(mask):
+            return np.bincount(groups[mask], minlength=n_groups)
+
+        def medians(values, mask):
+            g, v = groups[mask], values[mask]
+            order = np.lexsort((v, g))
+            g, v = g[order], v[order]
+            sizes = np.bincount(g, minlength=n_groups)
+            first = np.cumsum(sizes) - sizes
+            result = np.full(n_groups, np.nan)
+            has = sizes > 0
+            result[has] = (v[first[has] + (sizes[has] - 1) // 2] + v[first[has] + sizes[has] // 2]) / 2
+            return result
+
+        probed, reachable, tls_ok, verified = (counts(stage >= level) for level in (0, 1, 2, 4))
+        tcp_median = medians(tcp_ms, (stage >= 1) & ~np.isnan(tcp_ms))
+        tls_median = medians(tls_ms, (stage >= 2) & ~np.isnan(tls_ms))
+        labels = [f"{ipaddress.IPv4Address(int(key) << 8)}/24" for key in v4_keys] + \
+                 [f"{ipaddress.IPv6Address(int(key) << 80)}/48" for key in v6_keys]
+        return [(labels[idx], int(probed[idx]), int(reachable[idx]), int(tls_ok[idx]), int(verified[idx]),
+                 float(tcp_median[idx]), float(tls_median[idx])) for idx in np.flatnonzero(probed)]
+
+    def _subnet_rows_python(self) -> list:
+        groups = {}
+        for row in range(self.size):
+            stage = self.stage[row]
+            if stage < 0: continue
+            entry = groups.setdefault(subnet_key(self.address(row)), [0, 0, 0, 0, [], []])
+            entry[0] += 1
+            if stage >= 1:
+                entry[1] += 1
+                if not math.isnan(self.tcp_ms[row]): entry[4].append(self.tcp_ms[row])
+            if stage >= 2:
+                entry[2] += 1
+                if not math.isnan(self.tls_ms[row]): entry[5].append(self.tls_ms[row])
+            if stage >= 4: entry[3] += 1
+        return [(subnet, probed, reachable, tls_ok, verified,
+                 statistics.median(tcp) if tcp else math.nan, statistics.median(tls) if tls else math.nan)
+                for subnet, (probed, reachable, tls_ok, verified, tcp, tls) in groups.items()]
+
+    def export(self) -> list:
+        """Writes the per-address CSV, the per-subnet CSV and, with NumPy, a compressed .npz of the raw columns."""
+        written = []
+        # Best subnets first: highest TLS pass rate, then lowest median TLS RTT.
+        subnet_rows = sorted(self.subnet_rows(),
+                             key=lambda row: (-row[3] / row[1], math.inf if math.isnan(row[6]) else row[6]))
+        with open(LATENCY_SUBNETS_FILE, "w", newline="", encoding="utf-8") as f:
+            writer = csv.writer(f)
+            writer.writerow(["Subnet", "Probed", "Reachable", "TLS OK", "Verified", "Reachability", "TLS Pass Rate",
+                             "Median TCP (ms)", "Median TLS (ms)"])
+            for subnet, probed, reachable, tls_ok, verified, tcp_median, tls_median in subnet_rows:
+                writer.writerow([subnet, probed, reachable, tls_ok, verified, f"{reachable / probed:.3f}",
+                                 f"{tls_ok / probed:.3f}"] +
+                                ["" if math.isnan(value) else f"{value:.1f}" for value in (tcp_median, tls_median)])
+        written.append(LATENCY_SUBNETS_FILE)
+
+        with open(LATENCY_MAP_FILE + ".csv", "w", newline="", encoding="utf-8") as f:
+            writer = csv.writer(f)
+            writer.writerow(["IP Address", "Stage Reached", "TCP RTT (ms)", "TLS RTT (ms)"])
+            for row in range(self.size):
+                if self.stage[row] < 0: continue
+                writer.writerow([self.address(row), SUBNET_STAGES[self.stage[row]],
+                                 "" if math.isnan(self.tcp_ms[row]) else f"{self.tcp_ms[row]:.1f}",
+                                 "" if math.isnan(self.tls_ms[row]) else f"{self.tls_ms[row]:.1f}"])
+        written.append(LATENCY_MAP_FILE + ".csv")
+
+        if importlib.util.find_spec("numpy") is not None:
+            import numpy as np
+            np.savez_compressed(
+                LATENCY_MAP_FILE + ".npz", v4_addr=self._v4_addresses(np).astype(np.uint32),
+                v6_hi=np.frombuffer(self.v6_hi, dtype=np.uint64), v6_lo=np.frombuffer(self.v6_lo, dtype=np.uint64),
+                stage=np.frombuffer(self.stage, dtype=np.int8), tcp_ms=np.frombuffer(self.tcp_ms, dtype=np.float32),
+                tls_ms=np.frombuffer(self.tls_ms, dtype=np.float32))
+            written.append(LATENCY_MAP_FILE + ".npz")
+        return written
+
+
+def parse_cli_args():
+    import argparse
+    parser = argparse.ArgumentParser(description="WaldonCFscanner - Cloudflare Clean IP & Xray Verifier")
+    parser.add_argument("--api", type=int, metavar="PORT",
+                        help="serve the local control API on http://127.0.0.1:PORT")
+    parser.add_argument("--api-token", metavar="TOKEN",
+                        help="require this token on every API request (Authorization: Bearer TOKEN or ?token=TOKEN)")
+    parser.add_argument("--coordinator", metavar="[HOST:]PORT",
+                        help="split ipv4.txt/ipv6.txt into shards and serve them to remote workers")
+    parser.add_argument("--worker", metavar="HOST:PORT", help="scan shards leased from a coordinator")
+    parser.add_argument("--token", help="shared secret between coordinator and workers "
+                                        "(the coordinator makes one up and prints it when omitted)")
+    parser.add_argument("--shard-size", type=int, default=16, help="networks per shard (default: 16)")
+    parser.add_argument("--v6-samples", type=int, default=64,
+                        help="addresses sampled from each IPv6 network of a shard (default: 64)")
+    parser.add_argument("--ports", default="443", help="ports workers should scan (default: 443)")
+    parser.add_argument("--startup-benchmark", type=int, metavar="RUNS",
+                        help="launch the scanner RUNS times and report how long each boot phase takes")
+    parser.add_argument("--startup-probe", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--sweep", nargs="*", metavar="CIDR", type=lambda value: str(ipaddress.ip_network(value, strict=False)),
+                        help="probe every address of the given networks (default: all of ipv4.txt/ipv6.txt) "
+                             "and export a latency map")
+    parser.add_argument("--tls-benchmark", type=int, metavar="SAMPLES",
+                        help="compare handshake-only and HTTP TLS verification on SAMPLES live endpoints")
+    return parser.parse_args()
+
+
+def run_startup_benchmark(runs: int):
+    """Times cold launches in fresh processes, so every run pays the real import and Xray check cost."""
+    cmd = [sys.executable] if IS_COMPILED else [sys.executable, os.path.abspath(__file__)]
+    samples = {}
+    for _ in range(max(1, runs)):
+        started = time.perf_counter()
+        output = subprocess.run(cmd + ["--startup-probe"], capture_output=True, text=True).stdout
+        total = time.perf_counter() - started
+        try:
+            timings = json.loads(output.strip().splitlines()[-1])
+        except (IndexError, ValueError):
+            print("❌ Startup probe did not report timings.")
+            return
+        for phase, seconds in timings + [["process exit", total]]:
+            samples.setdefault(phase, []).append(seconds * 1000)
+
+    print(f"Startup benchmark over {max(1, runs)} run(s), cumulative ms since interpreter start:")
+    print(f"{'Phase':<16}{'Median':>10}{'Min':>10}{'Max':>10}")
+    for phase, values in samples.items():
+        print(f"{phase:<16}{statistics.median(values):>10.0f}{min(values):>10.0f}{max(values):>10.0f}")
+
+
+def split_host_port(value: str, default_host: str) -> tuple:
+    host, _, port = value.rpartition(":")
+    return host or default_host, int(port)
+
+
+def run_coordinator(cli_args):
+    links = []
+    for path in [URI_FILE] + ([os.path.join(CONFIGS_DIR, name) for name in sorted(os.listdir(CONFIGS_DIR))
+                               if name.endswith(".txt")] if os.path.isdir(CONFIGS_DIR) else []):
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                links.extend(extract_share_links(f.read()))
+
+    host, port = split_host_port(cli_args.coordinator, "0.0.0.0")
+    token = cli_args.token or secrets.token_urlsafe(16)
+    if not cli_args.token: print(f"🔑 No --token given. Workers must connect with: --token {token}")
+    coordinator = ShardCoordinator(host, port, build_shards(max(1, cli_args.shard_size)), links, cli_args.ports,
+                                   max(0, cli_args.v6_samples), token)
+    try:
+        asyncio.run(coordinator.serve())
+    except KeyboardInterrupt:
+        coordinator._write_outputs()
+
+
+def run_without_ui(cli_args) -> bool:
+    """Runs the modes that need no Textual UI; returns False when the UI should start instead."""
+    if cli_args.tls_benchmark:
+        asyncio.run(run_tls_benchmark(cli_args.tls_benchmark))
+    elif cli_args.startup_benchmark:
+        run_startup_benchmark(cli_args.startup_benchmark)
+    elif cli_args.coordinator:
+        run_coordinator(cli_args)
+    else:
+        return False
+    return True
+
+
+# Modes without a UI are dispatched before Textual is imported.
+if __name__ == "__main__":
+    cli_args = parse_cli_args()
+    if platform.system() == 'Windows':
+        asyncio.set_event_loop_policy(asyncio.WindowsProactorEventLoopPolicy())
+    if run_without_ui(cli_args): sys.exit(0)
+
+from textual import on
+from textual.app import App, ComposeResult
+from textual.widgets import Header, Footer, RichLog, DataTable, ProgressBar, Label, Button, Input, Switch
+from textual.containers import Horizontal, Vertical, Grid
+from textual.binding import Binding
+
+mark_boot("ui imports")
+
+
 class IPScannerUI(App):
     TITLE = "High-Speed Xray VLESS/Trojan Verification Engine"
 
@@ -192,13 +1843,14 @@ class IPScannerUI(App):
     #controls-container { height: auto; dock: top; padding: 1 2; background: #111111; border-bottom: solid #333333; }
     #header-row { height: 1; margin-bottom: 1; align: right middle; }
     #github-link { color: #00ffff; text-style: italic; }
-    #settings-grid { grid-size: 6 1; height: 3; grid-columns: auto 12 auto 12 auto 10; align: left middle; }
+    #settings-grid { grid-size: 8 3; height: 9; grid-columns: auto 12 auto 12 auto 10 auto 1fr; align: left middle; }
     #clipboard-row { height: 3; margin-top: 1; align: left middle; }
     #clipboard_input { width: 1fr; margin-left: 1; background: #222222; color: #00ff00; }
     #btn_paste { margin-left: 1; min-width: 15; }
     #button-grid { grid-size: 6 1; height: 3; grid-columns: 1fr 1fr 1fr 1fr 1fr 1fr; margin-top: 1; grid-gutter: 1; }
     .lbl { padding-top: 1; color: #ffffff; text-style: bold; }
     .inp { width: 10; background: #222222; color: #00ff00; }
+    .wide { width: 1fr; }
     .btn { width: 100%; }
     #pipelines { height: 7; margin: 1; }
     .queue-box { width: 1fr; height: 100%; border: round #444444; padding: 0 1; background: #111111; }
@@ -211,6 +1863,16 @@ class IPScannerUI(App):
 
     BINDINGS = [Binding("q", "quit", "Quit", priority=True)]
 
+    def __init__(self, api_port: int = None, coordinator: tuple = None, startup_probe: bool = False,
+                 sweep: list = None, v6_samples: int = 64, api_token: str = None):
+        super().__init__()
+        self.api_port = api_port
+        self.api_token = api_token
+        self.coordinator = coordinator
+        self.startup_probe = startup_probe
+        self.sweep = sweep
+        self.v6_samples = v6_samples
+
     def compose(self) -> ComposeResult:
         yield Header()
         with Vertical(id="controls-container"):
@@ -223,6 +1885,18 @@ class IPScannerUI(App):
                 yield Input("10", id="target_input", classes="inp")
                 yield Label("Debug Mode:", classes="lbl")
                 yield Switch(id="debug_switch", value=True)
+                yield Label("Ports:", classes="lbl")
+                yield Input("443", id="ports_input", placeholder="443 2053 8443 or cf", classes="inp wide")
+                yield Label("Min KB/s:", classes="lbl")
+                yield Input("100", id="min_speed_input", classes="inp")
+                yield Label("Budget MB:", classes="lbl")
+                yield Input("0", id="budget_input", placeholder="0 = unlimited", classes="inp")
+                yield Label("Link Mbps:", classes="lbl")
+                yield Input("0", id="link_rate_input", placeholder="0 = unlimited", classes="inp")
+                yield Label("Monitor:", classes="lbl")
+                yield Switch(id="monitor_switch", value=False)
+                yield Label("HTTP Check:", classes="lbl")
+                yield Switch(id="http_check_switch", value=False)
             with Horizontal(id="clipboard-row"):
                 yield Label("URI:", classes="lbl")
                 yield Input(placeholder="Paste vless:// or trojan:// here", id="clipboard_input")
@@ -240,13 +1914,13 @@ class IPScannerUI(App):
                 yield Label("1. TCP", classes="queue-title")
                 yield ProgressBar(id="tcp_bar", show_eta=False)
             with Vertical(classes="queue-box"):
-                yield Label("2. TLS", classes="queue-title")
+                yield Label("2. TLS", id="tls_title", classes="queue-title")
                 yield ProgressBar(id="tls_bar", show_eta=False)
             with Vertical(classes="queue-box"):
-                yield Label("3. Speed", classes="queue-title")
+                yield Label("3. Speed", id="speed_title", classes="queue-title")
                 yield ProgressBar(id="speed_bar", show_eta=False)
             with Vertical(classes="queue-box"):
-                yield Label("4. Xray Payload", classes="queue-title")
+                yield Label("4. Xray Payload", id="xray_title", classes="queue-title")
                 yield ProgressBar(id="xray_bar", show_eta=False)
             with Vertical(classes="queue-box", id="target-box"):
                 yield Label("Target", classes="queue-title")
@@ -434,18 +2108,39 @@ class IPScannerUI(App):
     def on_mount(self) -> None:
         self.log_view = self.query_one("#log_view", RichLog)
         self.results_table = self.query_one("#results_table", DataTable)
-        self.results_table.add_columns("Rank", "IP Address", "Speed", "TLS Lat.", "TTFB", "Score")
+        self.results_table.add_columns("Rank", "IP Address", "Port", "Config", "Speed", "TLS Lat.", "TTFB", "Score",
+                                       "Contention")
 
         self.is_scanning = False
         self.active_event = asyncio.Event()
         self.active_event.set()
         self.stop_event = asyncio.Event()
         self.tasks = []
-        self.found_ips = []
+        self.results = {}
+        self.result_uris = {}
+        self.verified_ips = set()
+        self.xray_pending = collections.Counter()
+        self.target_reached = False
         self.hot_subnets = []
         self.target_ips = 10
-        self.base_config = {}
-        self.base_uri = ""
+        self.monitor_mode = False
+        self.refill_event = asyncio.Event()
+        self.refill_event.set()
+        self.pool_health = {}
+        self.pool_baseline = {}
+        self.config_sources = []
+        self.shard_addresses = None
+        self.shard_results = None
+        self.subnet_stats = None
+        self.latency_map = None
+        self.producer_done = False
+        self.xray_templates = []
+        self.scan_ports = [443]
+        self.min_speed_kbps = 100
+        self.byte_budget = 0
+        self.bytes_used = 0
+        self.bytes_reserved = 0
+        self.bandwidth = BandwidthScheduler(0, SPEED_BASE_BYTES)
 
         self.active_tcp = 0
         self.active_tls = 0
@@ -457,61 +2152,154 @@ class IPScannerUI(App):
 
         self.xray_exe = os.path.join(BASE_DIR, "xray.exe" if platform.system() == "Windows" else "xray")
 
-        json_loaded = False
-        uri_loaded = False
-
-        if os.path.exists(CONFIG_FILE):
-            try:
-                with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
-                    self.base_config = json.load(f)
-                    json_loaded = True
-            except Exception as e:
-                logging.error(f"Failed to load config.json: {e}")
-
-        if os.path.exists(URI_FILE):
-            try:
-                with open(URI_FILE, 'r', encoding='utf-8') as f:
-                    self.base_uri = f.read().strip()
-                    if self.base_uri.startswith("vless://") or self.base_uri.startswith("trojan://"):
-                        uri_loaded = True
-            except Exception as e:
-                logging.error(f"Failed to load config.txt: {e}")
-
-        if json_loaded and not uri_loaded:
-            self.base_uri = self.parse_json_to_uri(self.base_config)
-            self.log_view.write("[cyan]Generated URI template from config.json[/cyan]")
-        elif uri_loaded and not json_loaded:
-            self.base_config = self.parse_uri_to_json(self.base_uri)
-            self.log_view.write("[cyan]Generated JSON template from config.txt[/cyan]")
+        self.config_sources = self._load_config_sources()
+        if self.config_sources:
+            self.log_view.write(f"[cyan]Loaded {len(self.config_sources)} config template(s)[/cyan]")
+            self.query_one("#clipboard_input", Input).value = " ".join(uri for _, uri in self.config_sources)
+            self._seed_ports_from_configs()
 
-        if self.base_uri:
-            self.query_one("#clipboard_input", Input).value = self.base_uri
+        self.xray_available = os.path.exists(self.xray_exe)
 
-        self.xray_enabled = os.path.exists(self.xray_exe) and bool(self.base_config)
-
-        if self.xray_enabled and platform.system() != "Windows":
+        if self.xray_available and platform.system() != "Windows":
             if not os.access(self.xray_exe, os.X_OK):
                 try:
                     st = os.stat(self.xray_exe)
                     os.chmod(self.xray_exe, st.st_mode | stat.S_IEXEC)
                 except Exception as e:
                     logging.error(f"Failed to make Xray executable: {e}")
-                    self.xray_enabled = False
+                    self.xray_available = False
+
+        self.xray_enabled = self._stage4_possible()
 
         self._load_networks()
 
-        if self.xray_enabled:
+        self.control_server = None
+        if self.api_port:
+            self.control_server = ControlServer(self, "127.0.0.1", self.api_port, self.api_token)
+            self._control_task = asyncio.create_task(self._start_control_server())
+
+        if self.coordinator:
+            self.log_view.write(f"[cyan]Worker mode: taking shards from {self.coordinator[0]}:{self.coordinator[1]}[/cyan]")
+            self._worker_task = asyncio.create_task(ShardWorkerClient(self, *self.coordinator).run())
+
+        if self.sweep is not None:
+            self._sweep_task = asyncio.create_task(self._run_sweep())
+
+        if self.xray_enabled and self.xray_available:
             self.log_view.write(f"[bold bright_green]System Ready. 4-Stage Xray Engine Armed.[/bold bright_green]")
+        elif self.xray_enabled:
+            self.log_view.write(
+                "[bold bright_green]System Ready. Xray Core missing, Stage 4 runs natively for VLESS/Trojan TLS/WS configs.[/bold bright_green]")
         else:
             self.log_view.write(
                 "[bold yellow]Xray Core missing or no config provided! Falling back to 3-Stage Pure Python.[/bold yellow]")
 
+        mark_boot("ui mounted")
+        if self.startup_probe: self.exit()
+
+    async def _start_control_server(self):
+        try:
+            await self.control_server.start()
+            self.log_view.write(f"[cyan]Control API listening on http://127.0.0.1:{self.api_port}[/cyan]")
+        except Exception as e:
+            logging.error(f"Failed to start control API: {e}")
+            self.log_view.write(f"[bold red]Control API failed to start: {e}[/bold red]")
+            self.control_server = None
+
+    async def on_unmount(self) -> None:
+        self.sni_reputation.save()
+        if self.control_server: await self.control_server.stop()
+
+    def _publish(self, event: str, data: dict):
+        if self.control_server: self.control_server.publish(event, data)
+
+    def status_snapshot(self) -> dict:
+        return {
+            "scanning": self.is_scanning,
+            "paused": self.is_scanning and not self.active_event.is_set(),
+            "verified_ips": len(self.verified_ips),
+            "results": len(self.results),
+            "bytes_used": self.bytes_used,
+            "monitor": self.monitor_mode,
+            "family_mix": {f"ipv{family}": round(share, 3) for family, share in self.family_mix.shares().items()},
+            "sni_quarantined": self.sni_reputation.quarantined_count(),
+            "stage_drops": self.stage_drops(),
+            "sweep": {"probed": self.latency_map.probed, "total": self.latency_map.size} if self.latency_map else None,
+            **self.settings_snapshot(),
+        }
+
+    def stage_drops(self) -> dict:
+        """Candidates discarded at the entrance of each stage because its queue was full of better ones."""
+        if not hasattr(self, "tcp_queue"): return {"tls": 0, "speed": 0, "xray": 0}
+        return {"tls": self.tcp_queue.drops, "speed": self.tls_queue.drops, "xray": self.xray_queue.drops}
+
+    def settings_snapshot(self) -> dict:
+        return {
+            "target": self.target_ips,
+            "power": self.query_one("#power_input", Input).value,
+            "ports": self.query_one("#ports_input", Input).value,
+        }
+
+    def apply_settings(self, settings: dict):
+        if "target" in settings:
+            self.target_ips = max(1, int(settings["target"]))
+            self.query_one("#target_input", Input).value = str(self.target_ips)
+        if "power" in settings:
+            self.query_one("#power_input", Input).value = str(max(1, min(100, int(settings["power"]))))
+        if "ports" in settings:
+            self.query_one("#ports_input", Input).value = str(settings["ports"])
+
+    def results_snapshot(self) -> list:
+        return [
+            {"ip": ip, "port": port, "config": name, "speed_kbps": round(speed), "tls_ms": round(tls_lat),
+             "ttfb_ms": round(xray_lat), "score": round(score, 2), "contention": contention,
+             "uri": self.result_uris[(ip, port, name)]}
+            for ip, port, name, speed, tls_lat, xray_lat, score, contention in self._sorted_results()
+        ]
+
+    def _load_config_sources(self) -> list:
+        json_files = [CONFIG_FILE]
+        uri_files = [URI_FILE]
+        if os.path.isdir(CONFIGS_DIR):
+            for name in sorted(os.listdir(CONFIGS_DIR)):
+                if name.endswith(".json"): json_files.append(os.path.join(CONFIGS_DIR, name))
+                elif name.endswith(".txt"): uri_files.append(os.path.join(CONFIGS_DIR, name))
+
+        json_configs = []
+        for path in json_files:
+            if not os.path.exists(path): continue
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+                json_configs.extend(c for c in (data if isinstance(data, list) else [data]) if isinstance(c, dict))
+            except Exception as e:
+                logging.error(f"Failed to load {os.path.basename(path)}: {e}")
+
+        uris = []
+        for path in uri_files:
+            if not os.path.exists(path): continue
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    uris.extend(extract_share_links(f.read()))
+            except Exception as e:
+                logging.error(f"Failed to load {os.path.basename(path)}: {e}")
+
+        # A lone config.json next to a lone config.txt describe the same server.
+        if len(json_configs) == 1 and len(uris) == 1 and self.parse_json_to_uri(json_configs[0]):
+            return [(json_configs[0], uris[0])]
+
+        sources = [(config, self.parse_json_to_uri(config)) for config in json_configs]
+        sources += [(self.parse_uri_to_json(uri), uri) for uri in uris]
+        return [(config, uri) for config, uri in sources if config and uri]
+
     def _action_paste_clipboard(self):
         try:
-            val = pyperclip.paste().strip()
-            if val.startswith("vless://") or val.startswith("trojan://"):
-                self.query_one("#clipboard_input", Input).value = val
-                self.log_view.write("[bold bright_green]URI successfully pasted from clipboard![/bold bright_green]")
+            import pyperclip
+            links = extract_share_links(pyperclip.paste())
+            if links:
+                self.query_one("#clipboard_input", Input).value = " ".join(links)
+                self.log_view.write(
+                    f"[bold bright_green]{len(links)} URI(s) successfully pasted from clipboard![/bold bright_green]")
             else:
                 self.log_view.write("[bold yellow]Clipboard does not contain a valid vless/trojan link.[/bold yellow]")
         except Exception as e:
@@ -519,29 +2307,128 @@ class IPScannerUI(App):
 
     @on(Input.Changed, "#clipboard_input")
     def on_clipboard_changed(self, event: Input.Changed):
-        val = event.value.strip()
-        if val.startswith("vless://") or val.startswith("trojan://"):
-            self.base_uri = val
-            self.base_config = self.parse_uri_to_json(val)
-            if self.base_config and os.path.exists(self.xray_exe):
-                if not self.xray_enabled:
-                    self.xray_enabled = True
-                    self.log_view.write(
-                        "[bold bright_green]Configuration loaded! Xray Engine Activated.[/bold bright_green]")
+        links = extract_share_links(event.value)
+        if links and links != [uri for _, uri in self.config_sources]:
+            self._apply_config_links(links)
+
+    def _stage4_possible(self) -> bool:
+        """Stage 4 runs when Xray is installed or at least one config can be verified natively."""
+        return any(self.xray_available or NativeVerifier.from_outbound(config["outbounds"][0])
+                   for config, _ in self.config_sources)
+
+    def _seed_ports_from_configs(self):
+        """Scans the ports the TLS configs are served on; plaintext configs keep their own port in Stage 4."""
+        ports = sorted({port for port, tls in map(outbound_endpoint, (c for c, _ in self.config_sources)) if port and tls})
+        if ports: self.query_one("#ports_input", Input).value = " ".join(map(str, ports))
+
+    def _apply_config_links(self, links: list):
+        sources = [(self.parse_uri_to_json(uri), uri) for uri in links]
+        self.config_sources = [(config, uri) for config, uri in sources if config]
+        self._seed_ports_from_configs()
+        if self._stage4_possible():
+            if not self.xray_enabled:
+                self.xray_enabled = True
+                self.log_view.write(
+                    "[bold bright_green]Configuration loaded! Xray Engine Activated.[/bold bright_green]")
+
+    def apply_worker_settings(self, welcome: dict):
+        if welcome.get("configs"):
+            self._apply_config_links(welcome["configs"])
+            self.query_one("#clipboard_input", Input).value = " ".join(welcome["configs"])
+        if welcome.get("ports"):
+            self.query_one("#ports_input", Input).value = welcome["ports"]
+
+    async def run_shard(self, networks: list, v6_samples: int) -> tuple:
+        """Sweeps one leased shard and returns its results, per-subnet stage counts and whether it was fully swept."""
+        self.shard_results = []
+        self.subnet_stats = {}
+        self.log_view.write(f"[cyan]Shard leased: {len(networks)} networks[/cyan]")
+        complete = await self._scan_addresses(iter_shard_addresses(networks, v6_samples))
+        return self.shard_results, self.subnet_stats, complete
+
+    async def _run_sweep(self):
+        if self.sweep:
+            networks = [ipaddress.ip_network(cidr, strict=False) for cidr in self.sweep]
+        else:
+            networks = [net for groups in self.network_groups.values() for nets in groups.values() for net in nets]
+        self.latency_map = LatencyMap(networks, self.v6_samples)
+        self.log_view.write(f"[cyan]Sweep mode: probing all {self.latency_map.size:,} addresses of "
+                            f"{len(networks)} networks[/cyan]")
+        await self._scan_addresses(self.latency_map.addresses())
+
+        try:
+            written = await asyncio.to_thread(self.latency_map.export)
+            self.log_view.write(f"[bold green]Latency map saved: {', '.join(os.path.basename(p) for p in written)}[/bold green]")
+            if not any(path.endswith(".npz") for path in written):
+                self.log_view.write("[yellow]Install numpy for the .npz export and faster subnet aggregation.[/yellow]")
+        except Exception as e:
+            logging.error(f"Failed to export latency map: {e}")
+            self.log_view.write(f"[bold red]Failed to export latency map: {e}[/bold red]")
+        finally:
+            # Later scans from the Start button are ordinary scans again.
+            self.latency_map = None
+
+    async def _scan_addresses(self, addresses) -> bool:
+        """Feeds the producer from a finite address iterator until every candidate has left the pipeline.
+
+        Returns False when the scan was stopped before the iterator was used up.
+        """
+        self.shard_addresses = addresses
+        self.producer_done = False
+        self.action_start_scan()
+        target_ips, self.target_ips = self.target_ips, sys.maxsize
+        complete = False
+        try:
+            while self.is_scanning:
+                if self.producer_done and self._pipeline_idle():
+                    # Shards and sweeps hand off without evicting; a drop would still mean an untested address.
+                    complete = not any(self.stage_drops().values())
+                    break
+                await asyncio.sleep(0.5)
+        finally:
+            if self.is_scanning: self.action_stop_scan()
+            self.shard_addresses = None
+            self.target_ips = target_ips
+            self.query_one("#target_bar", ProgressBar).total = self.target_ips
+        return complete
+
+    async def _hand_off(self, queue: StageQueue, priority, item):
+        """Passes a candidate to the next stage; returns the item dropped for it, if any.
+
+        Shard and sweep scans have to test every address, so they wait for room
+        instead of letting the queue evict its worst candidate.
+        """
+        if self.shard_addresses is not None:
+            await queue.push(priority, item)
+            return None
+        return queue.offer(priority, item)
+
+    def _pipeline_idle(self) -> bool:
+        queues = [self.raw_queue, self.tcp_queue, self.tls_queue, self.xray_queue]
+        active = self.active_tcp + self.active_tls + self.active_speed + self.active_xray
+        return active == 0 and all(queue.empty() for queue in queues)
+
+    def _count_subnet(self, ip: str, stage: int, rtt_ms: float = None):
+        if self.latency_map is not None: self.latency_map.record(ip, stage, rtt_ms)
+        if self.subnet_stats is None: return
+        counts = self.subnet_stats.setdefault(subnet_key(ip), [0] * len(SUBNET_STAGES))
+        counts[stage] += 1
 
     @on(Input.Changed, "#target_input")
     def update_target(self, event: Input.Changed):
         try:
             self.target_ips = max(1, int(event.value))
             self.query_one("#target_bar", ProgressBar).total = self.target_ips
-            if self.is_scanning and len(self.found_ips) >= self.target_ips:
-                self.log_view.write("[bold yellow]TARGET ADJUSTED & REACHED! Auto-stopping...[/bold yellow]")
-                self.action_stop_scan()
+            if self.is_scanning and self.monitor_mode:
+                self._sync_pool()
+            elif self.is_scanning:
+                self._check_target()
         except ValueError:
             pass
 
     def _load_networks(self):
-        self.network_groups = {}
+        # Groups are kept per address family so each family can get its own share of candidates.
+        self.network_groups = {4: {}, 6: {}}
         self.domains = []
         for file_path in [IPV4_FILE, IPV6_FILE]:
             if os.path.exists(file_path):
@@ -551,69 +2438,146 @@ class IPScannerUI(App):
                             net = ipaddress.ip_network(line.strip(), strict=False)
                             first_block = str(net.network_address).split('.')[0] if net.version == 4 else \
                             str(net.network_address).split(':')[0]
-                            if first_block not in self.network_groups:
-                                self.network_groups[first_block] = []
-                            self.network_groups[first_block].append(net)
+                            family_groups = self.network_groups[net.version]
+                            if first_block not in family_groups:
+                                family_groups[first_block] = []
+                            family_groups[first_block].append(net)
                         except ValueError:
                             pass
 
+        if self.network_groups[6] and not has_ipv6_route():
+            self.log_view.write("[bold yellow]No IPv6 route on this host. Scanning IPv4 ranges only.[/bold yellow]")
+            self.network_groups[6] = {}
+        self.network_groups = {family: groups for family, groups in self.network_groups.items() if groups}
+
         if not self.network_groups:
             self.log_view.write(
                 "[bold yellow]Warning: IP lists not found! Falling back to 104.16.x.x default.[/bold yellow]")
-            self.network_groups = {"104": [ipaddress.ip_network("104.16.0.0/12")]}
+            self.network_groups = {4: {"104": [ipaddress.ip_network("104.16.0.0/12")]}}
         else:
             self.log_view.write(f"[green]Network ranges loaded successfully.[/green]")
+        self.family_mix = FamilyMix(self.network_groups)
 
         if os.path.exists(DOMAINS_FILE):
             with open(DOMAINS_FILE, 'r') as f:
                 self.domains = [line.strip() for line in f if line.strip()]
         if not self.domains: self.domains = ["speed.cloudflare.com", "zula.ir"]
+        self.sni_reputation = SniReputation(self.domains, SNI_REPUTATION_FILE)
+        self.handshake_verify = tls_trust_store_available()
+        if not self.handshake_verify:
+            self.log_view.write("[bold yellow]No CA trust store found. Stage 2 will use the HTTP check.[/bold yellow]")
 
     def _generate_random_ip(self) -> str:
         if self.hot_subnets and random.random() < 0.30:
             net = random.choice(self.hot_subnets)
         else:
-            group_key = random.choice(list(self.network_groups.keys()))
-            net = random.choice(self.network_groups[group_key])
+            family_groups = self.network_groups[self.family_mix.choose()]
+            group_key = random.choice(list(family_groups.keys()))
+            net = random.choice(family_groups[group_key])
 
         if net.version == 4:
             return str(net[random.randint(1, net.num_addresses - 2)])
         else:
             return str(ipaddress.IPv6Address(int(net.network_address) + random.getrandbits(128 - net.prefixlen)))
 
-    def _generate_outputs_smart(self, new_uri: str, config: dict, ip: str):
+    def _generate_outputs_smart(self, new_uri: str, config: bytes, ip: str, port: int, template_idx: int = 0):
         try:
-            json_path = os.path.join(OUTPUT_DIR, f"config_{ip.replace(':', '_')}.json")
+            suffix = f"_{port}" if len(self.scan_ports) > 1 else ""
+            if len(self.xray_templates) > 1: suffix += f"_{template_idx + 1}"
+            json_path = os.path.join(OUTPUT_DIR, f"config_{ip.replace(':', '_')}{suffix}.json")
             with open(json_path, 'w', encoding='utf-8') as f:
-                json.dump(config, f, indent=2)
+                json.dump(json.loads(config), f, indent=2)
 
+            if self.monitor_mode: return
             uri_path = os.path.join(OUTPUT_DIR, "vless_links.txt")
             with open(uri_path, 'a', encoding='utf-8') as f:
                 f.write(new_uri + "\n")
         except Exception as e:
-            logging.error(f"Failed to generate output for {ip}: {e}")
+            logging.error(f"Failed to generate output for {ip}:{port}: {e}")
+
+    def _write_pool_links(self):
+        try:
+            uri_path = os.path.join(OUTPUT_DIR, "vless_links.txt")
+            tmp_path = uri_path + ".tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                for ip, port, name, *_ in self._sorted_results():
+                    f.write(self.result_uris[(ip, port, name)] + "\n")
+            os.replace(tmp_path, uri_path)
+        except Exception as e:
+            logging.error(f"Failed to rewrite pool links: {e}")
+
+    def _sorted_results(self) -> list:
+        rows = []
+        for (ip, port, name), (speed, tls_lat, xray_lat, score, contention) in self.results.items():
+            score *= self.pool_health.get((ip, port), 1.0)
+            rows.append((ip, port, name, speed, tls_lat, xray_lat, score, contention))
+        return sorted(rows, key=lambda x: x[6], reverse=True)
+
+    def _record_result(self, key: tuple, metrics: tuple, uri: str):
+        self.results[key] = metrics
+        self.result_uris[key] = uri
+        self.verified_ips.add(key[0])
+        self._count_subnet(key[0], 4)
+        if self.shard_results is not None:
+            self.shard_results.append(
+                {"ip": key[0], "port": key[1], "config": key[2], "speed_kbps": round(metrics[0]),
+                 "tls_ms": round(metrics[1]), "ttfb_ms": round(metrics[2]), "score": round(metrics[3], 2), "uri": uri})
+        self._publish("verified", {"ip": key[0], "port": key[1], "config": key[2], "speed_kbps": round(metrics[0]),
+                                   "ttfb_ms": round(metrics[2]), "uri": uri})
+        if self.monitor_mode:
+            self.pool_health.setdefault(key[:2], 1.0)
+            self._sync_pool(changed=True)
+        else:
+            self._refresh_table()
+
+    def _evict_endpoint(self, endpoint: tuple):
+        for key in [key for key in self.results if key[:2] == endpoint]:
+            del self.results[key]
+            del self.result_uris[key]
+        self.pool_health.pop(endpoint, None)
+        self.pool_baseline.pop(endpoint, None)
+        self.verified_ips = {ip for ip, _, _ in self.results}
+        self._publish("evicted", {"ip": endpoint[0], "port": endpoint[1]})
+
+    def _sync_pool(self, changed: bool = False):
+        """Trims the pool back to the best target_ips IPs and pauses or resumes discovery to match.
+
+        Whenever the pool changed, here or in the caller, vless_links.txt and the table are rewritten.
+        """
+        if len(self.verified_ips) > self.target_ips:
+            best = {}
+            for ip, port, _, _, _, _, score, _ in self._sorted_results():
+                best.setdefault(ip, score)
+            keep = set(sorted(best, key=best.get, reverse=True)[:self.target_ips])
+            for endpoint in {key[:2] for key in self.results if key[0] not in keep}:
+                self._evict_endpoint(endpoint)
+                changed = True
+        if changed:
+            self._write_pool_links()
+            self._refresh_table()
+
+        if len(self.verified_ips) >= self.target_ips:
+            if self.refill_event.is_set():
+                self.log_view.write("[bold yellow]POOL FULL! Discovery paused, monitoring pool...[/bold yellow]")
+            self.refill_event.clear()
+        elif not self.refill_event.is_set():
+            self.log_view.write("[bold yellow]Pool below target. Resuming discovery...[/bold yellow]")
+            self.refill_event.set()
 
     def _refresh_table(self):
         self.results_table.clear()
-        sorted_ips = sorted(self.found_ips, key=lambda x: x[4], reverse=True)
-        for idx, (ip, speed, tls_lat, xray_lat, score) in enumerate(sorted_ips):
-            self.results_table.add_row(str(idx + 1), ip, f"{speed:.0f} KB/s", f"{tls_lat:.0f} ms", f"{xray_lat:.0f} ms",
-                                       f"{score:.0f}")
+        for idx, (ip, port, name, speed, tls_lat, xray_lat, score, contention) in enumerate(self._sorted_results()):
+            self.results_table.add_row(str(idx + 1), ip, str(port), name, f"{speed:.0f} KB/s", f"{tls_lat:.0f} ms",
+                                       f"{xray_lat:.0f} ms", f"{score:.0f}", f"x{contention}")
 
     def on_button_pressed(self, event: Button.Pressed) -> None:
         btn_id = event.button.id
         if btn_id == "btn_start" and not self.is_scanning:
             self.action_start_scan()
         elif btn_id == "btn_pause" and self.is_scanning:
-            self.active_event.clear()
-            self.log_view.write("[bold yellow]Scan Paused.[/bold yellow]")
-            self.query_one("#btn_pause").disabled = True
-            self.query_one("#btn_resume").disabled = False
+            self.action_pause_scan()
         elif btn_id == "btn_resume" and self.is_scanning:
-            self.active_event.set()
-            self.log_view.write("[bold green]Scan Resumed.[/bold green]")
-            self.query_one("#btn_pause").disabled = False
-            self.query_one("#btn_resume").disabled = True
+            self.action_resume_scan()
         elif btn_id == "btn_stop" and self.is_scanning:
             self.action_stop_scan()
         elif btn_id == "btn_csv":
@@ -623,20 +2587,54 @@ class IPScannerUI(App):
         elif btn_id == "btn_paste":
             self._action_paste_clipboard()
 
+    def action_pause_scan(self):
+        self.active_event.clear()
+        self.log_view.write("[bold yellow]Scan Paused.[/bold yellow]")
+        self.query_one("#btn_pause").disabled = True
+        self.query_one("#btn_resume").disabled = False
+        self._publish("paused", {})
+
+    def action_resume_scan(self):
+        self.active_event.set()
+        self.log_view.write("[bold green]Scan Resumed.[/bold green]")
+        self.query_one("#btn_pause").disabled = False
+        self.query_one("#btn_resume").disabled = True
+        self._publish("resumed", {})
+
     def _manual_save_csv(self):
         try:
             with open(CSV_FILE, "w", newline="", encoding="utf-8") as f:
                 writer = csv.writer(f)
-                writer.writerow(
-                    ["Rank", "IP Address", "Speed (KB/s)", "TLS Latency (ms)", "TTFB (ms)", "Quality Score"])
-                sorted_ips = sorted(self.found_ips, key=lambda x: x[4], reverse=True)
-                for idx, (ip, speed, tls_lat, xray_lat, score) in enumerate(sorted_ips):
-                    writer.writerow([idx + 1, ip, f"{speed:.0f}", f"{tls_lat:.0f}", f"{xray_lat:.0f}", f"{score:.0f}"])
+                writer.writerow(["Rank", "IP Address", "Port", "Config", "Speed (KB/s)", "TLS Latency (ms)",
+                                 "TTFB (ms)", "Quality Score", "Contention"])
+                for idx, (ip, port, name, speed, tls_lat, xray_lat, score, contention) in enumerate(
+                        self._sorted_results()):
+                    writer.writerow([idx + 1, ip, port, name, f"{speed:.0f}", f"{tls_lat:.0f}", f"{xray_lat:.0f}",
+                                     f"{score:.0f}", contention])
             self.log_view.write(
-                f"[bold bright_cyan]Saved & Sorted {len(self.found_ips)} IPs to {CSV_FILE}[/bold bright_cyan]")
+                f"[bold bright_cyan]Saved & Sorted {len(self.results)} results to {CSV_FILE}[/bold bright_cyan]")
         except Exception as e:
             logging.error(f"Failed to save CSV: {e}")
 
+        if len(self.xray_templates) > 1:
+            self._save_compat_matrix()
+
+    def _save_compat_matrix(self):
+        try:
+            names = [template.name for template in self.xray_templates]
+            best = {}
+            for (ip, port, _), metrics in self.results.items():
+                best[(ip, port)] = max(best.get((ip, port), 0), metrics[3])
+            with open(MATRIX_FILE, "w", newline="", encoding="utf-8") as f:
+                writer = csv.writer(f)
+                writer.writerow(["IP Address", "Port"] + names)
+                for ip, port in sorted(best, key=best.get, reverse=True):
+                    cells = [self.results.get((ip, port, name)) for name in names]
+                    writer.writerow([ip, port] + [f"{cell[0]:.0f} KB/s" if cell else "" for cell in cells])
+            self.log_view.write(f"[bold bright_cyan]Compatibility matrix saved to {MATRIX_FILE}[/bold bright_cyan]")
+        except Exception as e:
+            logging.error(f"Failed to save compatibility matrix: {e}")
+
     def _manual_save_log(self):
         self.log_view.write(f"[bold bright_cyan]Professional Error Log saved![/bold bright_cyan]")
         self.log_view.write(f"[gray]Check 'scanner_error.log' in the folder.[/gray]")
@@ -649,6 +2647,7 @@ class IPScannerUI(App):
 
         self.query_one("#btn_start").disabled = True
         self.query_one("#btn_pause").disabled = False
+        self.query_one("#btn_resume").disabled = True
         self.query_one("#btn_stop").disabled = False
 
         try:
@@ -656,21 +2655,45 @@ class IPScannerUI(App):
         except ValueError:
             power_percent = 10
 
+        self.scan_ports = parse_port_list(self.query_one("#ports_input", Input).value)
+
+        try:
+            self.min_speed_kbps = max(1.0, float(self.query_one("#min_speed_input", Input).value))
+        except ValueError:
+            self.min_speed_kbps = 100
+        try:
+            self.byte_budget = max(0, int(float(self.query_one("#budget_input", Input).value) * 1024 * 1024))
+        except ValueError:
+            self.byte_budget = 0
+        self.bytes_used = 0
+        self.bytes_reserved = 0
+
+        try:
+            link_mbps = max(0.0, float(self.query_one("#link_rate_input", Input).value))
+        except ValueError:
+            link_mbps = 0.0
+        self.bandwidth = BandwidthScheduler(link_mbps * 1_000_000 / 8, SPEED_BASE_BYTES)
+
         max_sys_sockets = get_system_socket_capacity()
         active_sockets = int(max_sys_sockets * (power_percent / 100.0))
 
-        num_tcp_workers = max(5, int(active_sockets * 0.70))
+        num_tcp_workers = max(5, int(active_sockets * 0.70) // len(self.scan_ports))
         num_tls_workers = max(2, int(active_sockets * 0.20))
         num_speed_workers = max(1, int(active_sockets * 0.10))
         num_xray_workers = 15
 
         self.log_view.write(
-            f"[bold white]Engine: {power_percent}% Power ({active_sockets} active socket workers)[/bold white]")
+            f"[bold white]Engine: {power_percent}% Power ({active_sockets} active socket workers) | "
+            f"Ports: {', '.join(map(str, self.scan_ports))} | Min Speed: {self.min_speed_kbps:.0f} KB/s | "
+            f"Budget: {f'{self.byte_budget / 1048576:.0f} MB' if self.byte_budget else 'Unlimited'} | "
+            f"Link: {f'{link_mbps:g} Mbps' if link_mbps else 'Unlimited'}[/bold white]")
 
         self.raw_queue = asyncio.Queue(maxsize=num_tcp_workers * 2)
-        self.tcp_queue = asyncio.Queue(maxsize=num_tls_workers * 2)
-        self.tls_queue = asyncio.Queue(maxsize=num_speed_workers * 2)
-        self.xray_queue = asyncio.Queue(maxsize=num_xray_workers * 3)
+        # Stage hand-offs are priority queues: TCP connect time, then TLS latency, then measured speed.
+        self.tcp_queue = StageQueue(maxsize=num_tls_workers * 2)
+        self.tls_queue = StageQueue(maxsize=num_speed_workers * 2)
+        self.xray_queue = StageQueue(maxsize=num_xray_workers * 3 * max(1, len(self.config_sources)))
+        self.shown_drops = None
 
         self.query_one("#tcp_bar", ProgressBar).total = self.raw_queue.maxsize
         self.query_one("#tls_bar", ProgressBar).total = self.tcp_queue.maxsize
@@ -678,16 +2701,84 @@ class IPScannerUI(App):
         self.query_one("#xray_bar", ProgressBar).total = self.xray_queue.maxsize
         self.query_one("#target_bar", ProgressBar).total = self.target_ips
 
-        self.found_ips = []
+        self.results = {}
+        self.result_uris = {}
+        self.verified_ips = set()
+        self.xray_pending = collections.Counter()  # (ip, scanned port) -> config checks still queued
+        self.target_reached = False
         self.hot_subnets = []
+        self.family_mix = FamilyMix(self.network_groups)
         self.results_table.clear()
 
+        self.monitor_mode = self.query_one("#monitor_switch", Switch).value
+        self.pool_health = {}
+        self.pool_baseline = {}
+        self.refill_event.set()
+
+        self.xray_templates = []
+        if self.xray_enabled:
+            for idx, (config, uri) in enumerate(self.config_sources):
+                label = urllib.parse.unquote(urllib.parse.urlparse(uri).fragment) or config["outbounds"][0].get(
+                    "streamSettings", {}).get("network", "tcp")
+                try:
+                    template = XrayTemplate(config, uri, f"{idx + 1}. {label}")
+                    if template.native and template.native.fingerprint:
+                        if self.xray_available:
+                            # Only Xray reproduces the uTLS ClientHello that the real client will send.
+                            template.native = None
+                        else:
+                            self.log_view.write(
+                                f"[yellow]Config #{idx + 1}: fingerprint '{template.native.fingerprint}' is not emulated "
+                                f"without Xray. Stage 4 uses Python's TLS ClientHello, so results may differ on "
+                                f"networks that filter by TLS fingerprint.[/yellow]")
+                    if not template.native and not self.xray_available:
+                        self.log_view.write(f"[bold yellow]Config #{idx + 1} needs the Xray binary. Skipped.[/bold yellow]")
+                        continue
+                    self.xray_templates.append(template)
+                except Exception as e:
+                    logging.error(f"Failed to compile Xray template #{idx + 1}: {e}")
+                    self.log_view.write(f"[bold yellow]Config #{idx + 1} could not be compiled for Xray.[/bold yellow]")
+            if not self.xray_templates:
+                self.log_view.write("[bold yellow]No usable Xray config. Running 3-Stage Pure Python.[/bold yellow]")
+            elif len(self.xray_templates) > 1:
+                self.log_view.write(
+                    f"[cyan]Matrix mode: every IP is verified against {len(self.xray_templates)} configs.[/cyan]")
+
         self.tasks = [asyncio.create_task(self.ui_updater()), asyncio.create_task(self.producer_worker())]
         for _ in range(num_tcp_workers): self.tasks.append(asyncio.create_task(self.phase1_tcp_worker()))
         for _ in range(num_tls_workers): self.tasks.append(asyncio.create_task(self.phase2_tls_worker()))
         for _ in range(num_speed_workers): self.tasks.append(asyncio.create_task(self.phase3_speed_worker()))
-        if self.xray_enabled:
+        self._publish("started", self.status_snapshot())
+        if self.xray_templates:
             for _ in range(num_xray_workers): self.tasks.append(asyncio.create_task(self.phase4_xray_worker()))
+            if self.monitor_mode:
+                self.tasks.append(asyncio.create_task(self.monitor_worker()))
+                self.log_view.write(
+                    f"[cyan]Monitor mode: keeping the best {self.target_ips} IPs alive, re-checked every {MONITOR_INTERVAL}s.[/cyan]")
+
+    async def _reserve_download(self, base_bytes: int, max_bytes: int) -> int:
+        """Reserves part of the scan's byte budget for one speed test.
+
+        Returns the number of bytes the test may pull, or 0 once the budget is
+        spent (which also stops the scan).
+        """
+        if not self.byte_budget:
+            return max_bytes
+        while True:
+            if self.byte_budget - self.bytes_used < base_bytes:
+                if self.is_scanning:
+                    self.log_view.write("[bold yellow]BANDWIDTH BUDGET EXHAUSTED! Auto-stopping...[/bold yellow]")
+                    self.action_stop_scan()
+                return 0
+            available = self.byte_budget - self.bytes_used - self.bytes_reserved
+            if available >= base_bytes:
+                allowance = min(max_bytes, available)
+                self.bytes_reserved += allowance
+                return allowance
+            await asyncio.sleep(0.2)
+
+    def _release_download(self, allowance: int):
+        if self.byte_budget: self.bytes_reserved -= allowance
 
     def action_stop_scan(self):
         logging.info("Scan manually or automatically stopped.")
@@ -696,17 +2787,19 @@ class IPScannerUI(App):
         self.is_scanning = False
 
         try:
-            self.query_one("#target_bar", ProgressBar).progress = len(self.found_ips)
+            self.query_one("#target_bar", ProgressBar).progress = len(self.verified_ips)
         except Exception:
             pass
 
         self.log_view.write("[bold red]Scan Terminated.[/bold red]")
         self._manual_save_csv()
+        self.sni_reputation.save()
 
         self.query_one("#btn_start").disabled = False
         self.query_one("#btn_pause").disabled = True
         self.query_one("#btn_resume").disabled = True
         self.query_one("#btn_stop").disabled = True
+        self._publish("stopped", self.status_snapshot())
 
     async def ui_updater(self):
         try:
@@ -715,15 +2808,80 @@ class IPScannerUI(App):
                 self.query_one("#tls_bar", ProgressBar).progress = self.tcp_queue.qsize() + self.active_tls
                 self.query_one("#speed_bar", ProgressBar).progress = self.tls_queue.qsize() + self.active_speed
                 self.query_one("#xray_bar", ProgressBar).progress = self.xray_queue.qsize() + self.active_xray
-                self.query_one("#target_bar", ProgressBar).progress = len(self.found_ips)
+                if self.latency_map is not None:
+                    self.query_one("#target_bar", ProgressBar).update(total=self.latency_map.size,
+                                                                      progress=self.latency_map.probed)
+                else:
+                    self.query_one("#target_bar", ProgressBar).progress = len(self.verified_ips)
+                drops = self.stage_drops()
+                if drops != self.shown_drops:
+                    self.shown_drops = drops
+                    for (title, label), dropped in zip(
+                            [("#tls_title", "2. TLS"), ("#speed_title", "3. Speed"), ("#xray_title", "4. Xray Payload")],
+                            drops.values()):
+                        self.query_one(title, Label).update(f"{label} ({dropped} dropped)" if dropped else label)
                 await asyncio.sleep(0.1)
         except asyncio.CancelledError:
             pass
 
+    async def monitor_worker(self):
+        debug = self.query_one("#debug_switch", Switch).value
+        template_by_name = {template.name: template for template in self.xray_templates}
+
+        async def probe(ip, port, template):
+            if template.tls: return await probe_tls_handshake(ip, port, template.sni)
+            return (await probe_tcp_ports(ip, [port])).get(port)
+        try:
+            while not self.stop_event.is_set():
+                await asyncio.sleep(MONITOR_INTERVAL)
+                await self.active_event.wait()
+
+                endpoints = {}
+                for ip, port, name in self.results:
+                    endpoints.setdefault((ip, port), template_by_name[name])
+                if not endpoints: continue
+
+                latencies = await asyncio.gather(
+                    *(probe(ip, port, template) for (ip, port), template in endpoints.items()))
+
+                evicted = []
+                for endpoint, latency in zip(endpoints, latencies):
+                    if endpoint not in self.pool_health: continue
+                    if latency is None:
+                        sample = 0.0
+                    else:
+                        baseline = self.pool_baseline.setdefault(endpoint, latency)
+                        sample = min(1.0, 2 * baseline / latency)
+                    health = (1 - MONITOR_DECAY) * self.pool_health[endpoint] + MONITOR_DECAY * sample
+                    self.pool_health[endpoint] = health
+                    if debug: self.log_view.write(
+                        f"[bright_black]MONITOR:[/bright_black] {endpoint[0]}:{endpoint[1]} health {health:.2f}")
+                    if health < MONITOR_EVICT_BELOW:
+                        self._evict_endpoint(endpoint)
+                        evicted.append(endpoint)
+
+                for ip, port in evicted:
+                    self.log_view.write(f"[bold red]EVICTED:[/bold red] {ip}:{port} degraded")
+                if evicted:
+                    self._sync_pool(changed=True)
+                else:
+                    self._refresh_table()
+        except asyncio.CancelledError:
+            pass
+
     async def producer_worker(self):
         try:
             while not self.stop_event.is_set():
                 await self.active_event.wait()
+                await self.refill_event.wait()
+                if self.shard_addresses is not None:
+                    ip = next(self.shard_addresses, None)
+                    if ip is None:
+                        self.producer_done = True
+                        return
+                    # Every shard or sweep address has to be probed, so wait for room instead of skipping it.
+                    await self.raw_queue.put(ip)
+                    continue
                 ip = self._generate_random_ip()
                 try:
                     await asyncio.wait_for(self.raw_queue.put(ip), timeout=0.5)
@@ -744,15 +2902,15 @@ class IPScannerUI(App):
 
                 self.active_tcp += 1
                 try:
-                    fut = asyncio.open_connection(ip, 443)
-                    _, writer = await asyncio.wait_for(fut, timeout=1.5)
-                    writer.close()
-                    await writer.wait_closed()
-                    if debug: self.log_view.write(f"[bright_black]TCP OK:[/bright_black] {ip}")
-                    try:
-                        await asyncio.wait_for(self.tcp_queue.put(ip), timeout=1.0)
-                    except asyncio.TimeoutError:
-                        pass
+                    probe_started = time.monotonic()
+                    open_ports = await probe_tcp_ports(ip, self.scan_ports, timeout=1.5)
+                    self.family_mix.record(6 if ':' in ip else 4, bool(open_ports), time.monotonic() - probe_started)
+                    self._count_subnet(ip, 0)
+                    if open_ports: self._count_subnet(ip, 1, min(open_ports.values()))
+                    if open_ports and debug:
+                        self.log_view.write(f"[bright_black]TCP OK:[/bright_black] {ip} {list(open_ports)}")
+                    for port, connect_ms in open_ports.items():
+                        await self._hand_off(self.tcp_queue, connect_ms, (ip, port))
                 except Exception:
                     pass
                 finally:
@@ -761,48 +2919,53 @@ class IPScannerUI(App):
         except asyncio.CancelledError:
             pass
 
+    async def _verify_edge(self, ip: str, port: int, sni: str, http_check: bool):
+        """Handshake-only verdict first; the slower HTTP signature check only runs when enabled."""
+        if self.handshake_verify:
+            info = await inspect_tls_handshake(ip, port, sni)
+            if is_cf_handshake(info): return info["latency_ms"]
+            if not http_check: return None
+        return await probe_cf_signature(ip, port, sni)
+
     async def phase2_tls_worker(self):
         debug = self.query_one("#debug_switch", Switch).value
+        http_check = self.query_one("#http_check_switch", Switch).value
         try:
             while not self.stop_event.is_set():
                 await self.active_event.wait()
                 try:
-                    ip = await asyncio.wait_for(self.tcp_queue.get(), timeout=0.5)
+                    ip, port = await asyncio.wait_for(self.tcp_queue.get(), timeout=0.5)
                 except asyncio.TimeoutError:
                     continue
 
                 self.active_tls += 1
-                sni_domain = random.choice(self.domains)
                 try:
-                    context = ssl.create_default_context()
-                    context.check_hostname = False
-                    context.verify_mode = ssl.CERT_NONE
-
-                    start_time = time.monotonic()
-                    fut = asyncio.open_connection(ip, 443, ssl=context, server_hostname=sni_domain)
-                    reader, writer = await asyncio.wait_for(fut, timeout=2.0)
-
-                    request = f"GET / HTTP/1.1\r\nHost: {sni_domain}\r\nConnection: close\r\n\r\n".encode()
-                    writer.write(request)
-                    await writer.drain()
-
-                    response = await asyncio.wait_for(reader.read(1024), timeout=2.0)
-                    writer.close()
-                    await writer.wait_closed()
-
-                    tls_latency_ms = (time.monotonic() - start_time) * 1000
-
-                    if b"cloudflare" in response.lower() or b"403 Forbidden" in response:
+                    reputation = self.sni_reputation
+                    sni_domain = reputation.choose()
+                    tls_latency_ms = await self._verify_edge(ip, port, sni_domain, http_check)
+                    if tls_latency_ms is not None:
+                        reputation.record(sni_domain, True)
+                    else:
+                        # One retry with a proven SNI tells a bad domain apart from a bad IP. If both
+                        # fail, the IP is the likelier culprit and neither domain is blamed.
+                        fallback = reputation.known_good(sni_domain)
+                        if fallback:
+                            tls_latency_ms = await self._verify_edge(ip, port, fallback, http_check)
+                            if tls_latency_ms is not None:
+                                reputation.record(sni_domain, False)
+                                reputation.record(fallback, True)
+                        else:
+                            reputation.record(sni_domain, False)
+
+                    if tls_latency_ms is not None:
                         if debug: self.log_view.write(
-                            f"[bright_magenta]TLS OK:[/bright_magenta] {ip} ({tls_latency_ms:.0f}ms)")
+                            f"[bright_magenta]TLS OK:[/bright_magenta] {ip}:{port} ({tls_latency_ms:.0f}ms)")
+                        self._count_subnet(ip, 2, tls_latency_ms)
                         subnet_str = ip.rsplit('.', 1)[0] + '.0/24' if '.' in ip else ip.rsplit(':', 1)[0] + '::/48'
                         self.hot_subnets.append(ipaddress.ip_network(subnet_str, strict=False))
                         if len(self.hot_subnets) > 50: self.hot_subnets.pop(0)
 
-                        try:
-                            await asyncio.wait_for(self.tls_queue.put((ip, tls_latency_ms)), timeout=1.0)
-                        except asyncio.TimeoutError:
-                            pass
+                        await self._hand_off(self.tls_queue, tls_latency_ms, (ip, port, tls_latency_ms))
                 except Exception:
                     pass
                 finally:
@@ -818,45 +2981,66 @@ class IPScannerUI(App):
                 await self.active_event.wait()
                 try:
                     data = await asyncio.wait_for(self.tls_queue.get(), timeout=0.5)
-                    ip, tls_latency_ms = data
+                    ip, port, tls_latency_ms = data
                 except asyncio.TimeoutError:
                     continue
 
                 self.active_speed += 1
+                allowance = 0
+                lease = None
                 try:
+                    allowance = await self._reserve_download(SPEED_BASE_BYTES, SPEED_MAX_BYTES)
+                    if not allowance: continue
+                    lease = await self.bandwidth.admit(SPEED_BASE_BYTES)
+
                     context = ssl.create_default_context()
                     context.check_hostname = False
                     context.verify_mode = ssl.CERT_NONE
 
-                    start_time = time.monotonic()
-                    fut = asyncio.open_connection(ip, 443, ssl=context, server_hostname="speed.cloudflare.com")
+                    fut = asyncio.open_connection(ip, port, ssl=context, server_hostname="speed.cloudflare.com")
                     reader, writer = await asyncio.wait_for(fut, timeout=3.0)
 
                     http_req = (
-                        f"GET /__down?bytes=100000 HTTP/1.1\r\nHost: speed.cloudflare.com\r\nUser-Agent: Mozilla/5.0\r\nConnection: close\r\n\r\n").encode()
+                        f"GET /__down?bytes={allowance} HTTP/1.1\r\nHost: speed.cloudflare.com\r\nUser-Agent: Mozilla/5.0\r\nConnection: close\r\n\r\n").encode()
                     writer.write(http_req)
                     await writer.drain()
 
-                    total_bytes = 0
-                    while True:
-                        chunk = await asyncio.wait_for(reader.read(8192), timeout=2.0)
-                        if not chunk: break
-                        total_bytes += len(chunk)
-
-                    writer.close()
-                    await writer.wait_closed()
-
-                    if total_bytes > 50000:
-                        if self.xray_enabled:
+                    meter = AdaptiveSpeedMeter(self.min_speed_kbps, SPEED_BASE_BYTES, allowance)
+                    verdict = meter.CONTINUE
+                    try:
+                        while verdict == meter.CONTINUE:
+                            chunk = await asyncio.wait_for(reader.read(65536), timeout=2.0)
+                            if not chunk:
+                                verdict = meter.finish()
+                                break
+                            self.bytes_used += len(chunk)
+                            lease.used_bytes += len(chunk)
+                            verdict = meter.feed(len(chunk))
+                    finally:
+                        writer.close()
+                        self.bandwidth.release(lease)
+                    # Give back the unused budget now; the hand-off below may wait on Stage 4.
+                    self._release_download(allowance)
+                    allowance = 0
+
+                    if verdict == meter.PASS:
+                        self._count_subnet(ip, 3)
+                        if self.xray_templates:
                             if debug: self.log_view.write(
-                                f"[bright_cyan]SPEED OK:[/bright_cyan] {ip} -> Sending to Xray")
-                            try:
-                                await asyncio.wait_for(self.xray_queue.put((ip, tls_latency_ms)), timeout=1.5)
-                            except asyncio.TimeoutError:
-                                pass
+                                f"[bright_cyan]SPEED OK:[/bright_cyan] {ip}:{port} ({meter.kbps:.0f} KB/s, contention x{lease.contention}) -> Sending to Xray")
+                            for template_idx in range(len(self.xray_templates)):
+                                self.xray_pending[(ip, port)] += 1
+                                dropped = await self._hand_off(self.xray_queue, (-meter.kbps, tls_latency_ms),
+                                                               (ip, port, tls_latency_ms, template_idx))
+                                if dropped: self.xray_pending[dropped[:2]] -= 1
+                    elif debug:
+                        self.log_view.write(
+                            f"[gray]Too slow: {ip}:{port} ({meter.kbps:.0f} KB/s after {meter.total_bytes // 1024} KB)[/gray]")
                 except Exception as e:
                     pass
                 finally:
+                    if lease: self.bandwidth.release(lease)
+                    self._release_download(allowance)
                     self.active_speed -= 1
                     self.tls_queue.task_done()
         except asyncio.CancelledError:
@@ -864,118 +3048,115 @@ class IPScannerUI(App):
 
     async def phase4_xray_worker(self):
         debug = self.query_one("#debug_switch", Switch).value
+        proxy_errors = (NativeProxyError, OSError, EOFError)
+        if not all(template.native for template in self.xray_templates):
+            import aiohttp
+            proxy_errors += (aiohttp.ClientError,)
         try:
             while not self.stop_event.is_set():
                 await self.active_event.wait()
                 try:
                     data = await asyncio.wait_for(self.xray_queue.get(), timeout=0.5)
-                    ip, tls_latency_ms = data
+                    ip, port, tls_latency_ms, template_idx = data
+                    template = self.xray_templates[template_idx]
+                    endpoint = (ip, port)
+                    port = template.stage4_port(port, self.scan_ports)
                 except asyncio.TimeoutError:
                     continue
 
                 self.active_xray += 1
                 proc = None
-                tmp_path = None
                 drain_task = None
+                allowance = 0
+                lease = None
 
                 try:
+                    # Once the target is reached, only the remaining configs of the verified IPs are checked.
+                    if self.target_reached and ip not in self.verified_ips: continue
+                    allowance = await self._reserve_download(XRAY_BASE_BYTES, XRAY_MAX_BYTES)
+                    if not allowance: continue
+
                     local_port = random.randint(20000, 50000)
-                    config = copy.deepcopy(self.base_config)
-
-                    config.pop("routing", None)
-                    config.pop("dns", None)
-                    config["inbounds"][0]["port"] = local_port
-                    config["inbounds"][0]["protocol"] = "mixed"
-
-                    scheme = config["outbounds"][0]["protocol"]
-                    if scheme == "vless":
-                        config["outbounds"][0]["settings"]["vnext"][0]["address"] = ip
-                    elif scheme == "trojan":
-                        config["outbounds"][0]["settings"]["servers"][0]["address"] = ip
-
-                    fd, tmp_path = tempfile.mkstemp(suffix=".json")
-                    with os.fdopen(fd, 'w') as f:
-                        json.dump(config, f)
-
-                    proc = await asyncio.create_subprocess_exec(
-                        self.xray_exe, "run", "-c", tmp_path,
-                        stdout=asyncio.subprocess.PIPE,
-                        stderr=asyncio.subprocess.STDOUT
-                    )
-
-                    async def drain_output():
-                        try:
-                            while True:
-                                line = await proc.stdout.readline()
-                                if not line: break
-                                text = line.decode('utf-8', errors='ignore').strip()
-                                logging.debug(f"[XRAY {ip}] {text}")
-                                if debug and "deprecated" not in text:
-                                    self.log_view.write(f"[gray]⚙️ XRAY ({ip}): {text}[/gray]")
-                        except Exception:
-                            pass
+                    config = template.render(ip, port, local_port)
+
+                    if not template.native:
+                        proc = await asyncio.create_subprocess_exec(
+                            self.xray_exe, "run", "-c", "stdin:", "-format", "json",
+                            stdin=asyncio.subprocess.PIPE,
+                            stdout=asyncio.subprocess.PIPE,
+                            stderr=asyncio.subprocess.STDOUT
+                        )
+                        proc.stdin.write(config)
+                        await proc.stdin.drain()
+                        proc.stdin.close()
+
+                        async def drain_output():
+                            try:
+                                while True:
+                                    line = await proc.stdout.readline()
+                                    if not line: break
+                                    text = line.decode('utf-8', errors='ignore').strip()
+                                    logging.debug(f"[XRAY {ip}] {text}")
+                                    if debug and "deprecated" not in text:
+                                        self.log_view.write(f"[gray]⚙️ XRAY ({ip}): {text}[/gray]")
+                            except Exception:
+                                pass
 
-                    drain_task = asyncio.create_task(drain_output())
-                    await asyncio.sleep(1.5)
+                        drain_task = asyncio.create_task(drain_output())
+                        await asyncio.sleep(1.5)
 
+                    lease = await self.bandwidth.admit(XRAY_BASE_BYTES)
                     start_time = time.monotonic()
 
-                    async with aiohttp.ClientSession() as session:
-                        async with session.get("https://speed.cloudflare.com/__down?bytes=500000",
-                                               proxy=f"http://127.0.0.1:{local_port}", timeout=10) as resp:
-                            ttfb_ms = (time.monotonic() - start_time) * 1000
-
-                            if resp.status == 200:
-                                body = await resp.read()
-                                total_bytes = len(body)
-                                download_time = max(time.monotonic() - start_time - (ttfb_ms / 1000), 0.1)
-
-                                if total_bytes >= 100000:
-                                    speed_kbps = (total_bytes / 1024) / download_time
-
-                                    parsed = urllib.parse.urlparse(self.base_uri)
-                                    scheme = parsed.scheme
-                                    uuid, server_port = parsed.netloc.split("@", 1)
-                                    original_server = server_port.split(":")[0]
-                                    port = server_port.split(":")[1] if ":" in server_port else "443"
-
-                                    qs = urllib.parse.parse_qs(parsed.query, keep_blank_values=True)
-                                    params = {k: v[0] for k, v in qs.items()}
-
-                                    if not params.get("sni"): params["sni"] = original_server
-                                    if not params.get("host"): params["host"] = params["sni"]
-                                    if not params.get("fp"): params["fp"] = "chrome"
-
-                                    new_query = urllib.parse.urlencode(params, safe=":/,")
-                                    fragment = f"#{parsed.fragment}" if parsed.fragment else "#Verified"
-                                    formatted_ip = f"[{ip}]" if ":" in ip else ip
-
-                                    new_uri = f"{scheme}://{uuid}@{formatted_ip}:{port}?{new_query}{fragment}"
-                                    quality_score = speed_kbps / max(ttfb_ms, 1)
-
-                                    self.log_view.write(
-                                        f"[bold bright_green]XRAY VERIFIED![/bold bright_green] {ip} | {speed_kbps:.0f} KB/s | TTFB: {ttfb_ms:.0f} ms")
-                                    self.found_ips.append((ip, speed_kbps, tls_latency_ms, ttfb_ms, quality_score))
-                                    self._generate_outputs_smart(new_uri, config, ip)
-                                    self._refresh_table()
-
-                                    if len(self.found_ips) >= self.target_ips:
-                                        self.log_view.write(
-                                            "[bold yellow]TARGET REACHED! Auto-stopping...[/bold yellow]")
-                                        self.action_stop_scan()
-                                else:
-                                    if debug: self.log_view.write(f"[red]Payload too small from {ip}[/red]")
+                    async with contextlib.AsyncExitStack() as stack:
+                        if template.native:
+                            resp = await stack.enter_async_context(
+                                template.native.get(ip, port, f"/__down?bytes={allowance}", timeout=10))
+                        else:
+                            session = await stack.enter_async_context(aiohttp.ClientSession())
+                            resp = await stack.enter_async_context(
+                                session.get(f"https://speed.cloudflare.com/__down?bytes={allowance}",
+                                            proxy=f"http://127.0.0.1:{local_port}", timeout=10))
+                        ttfb_ms = (time.monotonic() - start_time) * 1000
+
+                        if resp.status == 200:
+                            meter = AdaptiveSpeedMeter(self.min_speed_kbps, XRAY_BASE_BYTES, allowance)
+                            verdict = meter.CONTINUE
+                            async for chunk in resp.content.iter_any():
+                                self.bytes_used += len(chunk)
+                                lease.used_bytes += len(chunk)
+                                verdict = meter.feed(len(chunk))
+                                if verdict != meter.CONTINUE: break
+                            else:
+                                verdict = meter.finish()
+                            self.bandwidth.release(lease)
+
+                            if verdict == meter.PASS:
+                                speed_kbps = meter.kbps
+                                new_uri = template.share_uri(ip, port)
+                                quality_score = speed_kbps / max(ttfb_ms, 1)
+
+                                self.log_view.write(
+                                    f"[bold bright_green]XRAY VERIFIED![/bold bright_green] {ip}:{port} [{template.name}] | {speed_kbps:.0f} KB/s | TTFB: {ttfb_ms:.0f} ms | Contention: x{lease.contention}")
+                                self._generate_outputs_smart(new_uri, config, ip, port, template_idx)
+                                self._record_result((ip, port, template.name), (
+                                    speed_kbps, tls_latency_ms, ttfb_ms, quality_score, lease.contention), new_uri)
                             else:
-                                if debug: self.log_view.write(f"[red]❌ HTTP {resp.status} Error on {ip}[/red]")
+                                if debug: self.log_view.write(
+                                    f"[red]Too slow through the proxy from {ip} ({meter.kbps:.0f} KB/s)[/red]")
+                        else:
+                            if debug: self.log_view.write(f"[red]❌ HTTP {resp.status} Error on {ip}[/red]")
 
                 except (asyncio.TimeoutError, TimeoutError):
                     if debug: self.log_view.write(f"[gray]❌ Timeout on {ip} (Too Slow/Blocked)[/gray]")
-                except aiohttp.ClientError as e:
+                except proxy_errors as e:
                     if debug: self.log_view.write(f"[gray]❌ Proxy Reject on {ip}: {str(e)}[/gray]")
                 except Exception as e:
                     logging.exception(f"Xray Critical Error on {ip}: {str(e)}")
                     if debug: self.log_view.write(f"[red]❌ Critical Parse Error on {ip}: Check error log![/red]")
                 finally:
+                    if lease: self.bandwidth.release(lease)
+                    self._release_download(allowance)
                     if drain_task: drain_task.cancel()
                     if proc and proc.returncode is None:
                         proc.terminate()
@@ -983,20 +3164,38 @@ class IPScannerUI(App):
                             await asyncio.wait_for(proc.wait(), timeout=1.0)
                         except asyncio.TimeoutError:
                             proc.kill()
-                    if tmp_path and os.path.exists(tmp_path):
-                        try:
-                            os.remove(tmp_path)
-                        except OSError:
-                            pass
 
                     self.active_xray -= 1
                     self.xray_queue.task_done()
+                    self.xray_pending[endpoint] -= 1
+                    if self.xray_pending[endpoint] <= 0: del self.xray_pending[endpoint]
+                    self._check_target()
         except asyncio.CancelledError:
             pass
 
+    def _check_target(self):
+        """Auto-stops at the target, after the still queued configs of the verified IPs have been checked."""
+        if self.monitor_mode or not self.is_scanning or len(self.verified_ips) < self.target_ips: return
+        waiting = sum(count for (ip, _), count in self.xray_pending.items() if ip in self.verified_ips)
+        if waiting:
+            if not self.target_reached:
+                self.log_view.write(f"[bold yellow]TARGET REACHED! Finishing {waiting} queued config check(s) "
+                                    f"of the verified IPs...[/bold yellow]")
+            self.target_reached = True
+            return
+        self.log_view.write("[bold yellow]TARGET REACHED! Auto-stopping...[/bold yellow]")
+        self.action_stop_scan()
+
 
 if __name__ == "__main__":
-    if platform.system() == 'Windows':
-        asyncio.set_event_loop_policy(asyncio.WindowsProactorEventLoopPolicy())
-    app = IPScannerUI()
-    app.run()
\ No newline at end of file
+    if cli_args.startup_probe:
+        IPScannerUI(startup_probe=True).run(headless=True)
+        print(json.dumps(BOOT_TIMINGS))
+    elif cli_args.worker:
+        app = IPScannerUI(api_port=cli_args.api, api_token=cli_args.api_token,
+                          coordinator=(*split_host_port(cli_args.worker, "127.0.0.1"), cli_args.token))
+        app.run(headless=True)
+    else:
+        app = IPScannerUI(api_port=cli_args.api, api_token=cli_args.api_token, sweep=cli_args.sweep,
+                          v6_samples=max(0, cli_args.v6_samples))
+        app.run()